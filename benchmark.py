@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for unfolder.py "rename" and "repack".
+
+- A deterministic synthetic image tree is generated from a seed: depth, fan-out,
+  files per directory and name lengths are configurable, as is the share of files
+  whose flattened name collides with an existing file and the share of
+  top-level directories holding a <name>/<name>.<ext> file.
+- Each run times rename, repack and the full round-trip on every target
+  (tmpfs and/or disk), checks that the round-trip restores the original tree,
+  and reports files/second and filesystem calls per file. The round-trip check
+  only applies to --floor 0, since repack restores files from the root only.
+- Startup cost is measured in fresh interpreters: the cumulative import time of
+  unfolder as reported by `python -X importtime`, and the wall time of `--help`
+  and of a rename on an empty directory.
+
+Filesystem calls are counted by wrapping the os functions the tool goes through
+(plus renameat2); stats done implicitly by DirEntry are not visible, and neither
+are calls made by worker processes when --processes is above 1.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import string
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+import unfolder
+
+COUNTED_OS_CALLS = (
+    "scandir",
+    "open",
+    "close",
+    "stat",
+    "lstat",
+    "rename",
+    "replace",
+    "remove",
+    "rmdir",
+    "mkdir",
+    "fsync",
+)
+
+
+def _random_name(rng: random.Random, length: int) -> str:
+    return "".join(rng.choice(string.ascii_lowercase + string.digits) for _ in range(length))
+
+
+def generate_tree(
+    root: str,
+    depth: int,
+    fanout: int,
+    files: int,
+    name_len: int,
+    collision_rate: float,
+    self_dir_rate: float,
+    seed: int,
+    floor: int = 0,
+) -> int:
+    """
+    Create a synthetic image tree under root and return the number of files in it.
+
+    The same arguments always produce the same tree. Colliding names are placed in
+    the directory that rename with the given floor flattens into.
+    """
+    rng = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+    count = 0
+    stack: List[Tuple[str, List[str], int]] = [(root, [], 0)]
+    while stack:
+        dir_path, rel_parts, level = stack.pop()
+        for _ in range(files if level > 0 else 0):
+            name = _random_name(rng, name_len) + ".jpg"
+            with open(os.path.join(dir_path, name), "wb"):
+                pass
+            count += 1
+            if level > floor + 1 and rng.random() < collision_rate:
+                # Occupy the flattened name so rename has to skip this file.
+                flattened = "_".join(rel_parts[floor:] + [name])
+                with open(os.path.join(root, *rel_parts[:floor], flattened), "wb"):
+                    pass
+                count += 1
+        if level == 1 and rng.random() < self_dir_rate:
+            with open(os.path.join(dir_path, rel_parts[-1] + ".jpg"), "wb"):
+                pass
+            count += 1
+        if level < depth:
+            for _ in range(fanout):
+                name = _random_name(rng, name_len)
+                child = os.path.join(dir_path, name)
+                os.mkdir(child)
+                stack.append((child, rel_parts + [name], level + 1))
+    return count
+
+
+def _snapshot(root: str) -> List[str]:
+    paths = []
+    for dir_path, dir_names, file_names in os.walk(root):
+        rel = os.path.relpath(dir_path, root)
+        paths.extend(os.path.join(rel, name) for name in dir_names)
+        paths.extend(os.path.join(rel, name) for name in file_names)
+    return sorted(paths)
+
+
+class SyscallCounter:
+    """Counts calls to the os functions used by unfolder while active."""
+
+    def __init__(self):
+        self.counts: Dict[str, int] = {}
+        self._saved: Dict[str, object] = {}
+        self._saved_renameat2 = None
+
+    def _wrap(self, name: str, fn):
+        counts = self.counts
+
+        def counted(*args, **kwargs):
+            counts[name] = counts.get(name, 0) + 1
+            return fn(*args, **kwargs)
+
+        return counted
+
+    def __enter__(self) -> "SyscallCounter":
+        for name in COUNTED_OS_CALLS:
+            fn = getattr(os, name)
+            self._saved[name] = fn
+            setattr(os, name, self._wrap(name, fn))
+        self._saved_renameat2 = unfolder._renameat2
+        renameat2 = unfolder._get_renameat2()
+        if renameat2 is not None:
+            unfolder._renameat2 = self._wrap("renameat2", renameat2)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        for name, fn in self._saved.items():
+            setattr(os, name, fn)
+        unfolder._renameat2 = self._saved_renameat2
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+
+def _timed(fn, *args, **kwargs) -> Tuple[float, SyscallCounter]:
+    counter = SyscallCounter()
+    with counter:
+        start = time.perf_counter()
+        fn(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+    return elapsed, counter
+
+
+def run_target(target: str, base_dir: str, args: argparse.Namespace) -> List[Dict[str, object]]:
+    results: Dict[str, Dict[str, object]] = {}
+    for _ in range(args.repeat):
+        work = tempfile.mkdtemp(prefix="unfolder-bench-", dir=base_dir)
+        try:
+            root = os.path.join(work, "tree")
+            lib_path = os.path.join(work, ".rename_lib")
+            n_files = generate_tree(
+                root,
+                args.depth,
+                args.fanout,
+                args.files,
+                args.name_len,
+                args.collision_rate,
+                args.self_dir_rate,
+                args.seed,
+                args.floor,
+            )
+            before = _snapshot(root)
+            rename_time, rename_calls = _timed(
+                unfolder.cmd_rename,
+                root=root,
+                floor=args.floor,
+                lib_path=lib_path,
+                collapse_self_dir=True,
+                scan_workers=args.scan_workers,
+                workers=args.workers,
+                processes=args.processes,
+            )
+            repack_time, repack_calls = _timed(
+                unfolder.cmd_repack,
+                root=root,
+                lib_path=lib_path,
+                keep_lib=False,
+                workers=args.workers,
+            )
+            # repack only restores files at the root, i.e. what rename with floor 0 made.
+            restored = _snapshot(root) == before if args.floor == 0 else None
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+
+        for op, seconds, calls in (
+            ("rename", rename_time, rename_calls.total),
+            ("repack", repack_time, repack_calls.total),
+            ("round-trip", rename_time + repack_time, rename_calls.total + repack_calls.total),
+        ):
+            best = results.get(op)
+            if best is None or seconds < best["seconds"]:
+                results[op] = {
+                    "target": target,
+                    "op": op,
+                    "files": n_files,
+                    "seconds": seconds,
+                    "files_per_second": n_files / seconds if seconds else float("inf"),
+                    "syscalls_per_file": calls / n_files if n_files else 0.0,
+                    "restored": restored,
+                }
+        if restored is False:
+            print("Round-trip on %s did not restore the original tree." % target, file=sys.stderr)
+    return list(results.values())
+
+
+UNFOLDER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "unfolder.py")
+
+
+def _import_time(repeat: int) -> float:
+    """Fastest cumulative import time of unfolder in seconds, from -X importtime."""
+    best = float("inf")
+    for _ in range(repeat):
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import unfolder"],
+            cwd=os.path.dirname(UNFOLDER_PATH),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        for line in proc.stderr.splitlines():
+            fields = [field.strip() for field in line.split("|")]
+            if len(fields) == 3 and fields[2] == "unfolder":
+                best = min(best, int(fields[1]) / 1e6)
+    return best
+
+
+def _command_time(args: List[str], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, UNFOLDER_PATH] + args, stdout=subprocess.DEVNULL, check=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def measure_startup(repeat: int) -> List[Dict[str, object]]:
+    rows: List[Dict[str, object]] = [{"target": "startup", "op": "import", "seconds": _import_time(repeat)}]
+    rows.append({"target": "startup", "op": "--help", "seconds": _command_time(["--help"], repeat)})
+    with tempfile.TemporaryDirectory(prefix="unfolder-bench-") as empty:
+        for mode in ("per-file", "off"):
+            rows.append(
+                {
+                    "target": "startup",
+                    "op": "rename empty (log %s)" % mode,
+                    "seconds": _command_time(["rename", "--dir", empty, "--log-mode", mode], repeat),
+                }
+            )
+    return rows
+
+
+def _default_targets() -> Dict[str, Optional[str]]:
+    targets: Dict[str, Optional[str]] = {}
+    if os.path.isdir("/dev/shm"):
+        targets["tmpfs"] = "/dev/shm"
+    targets["disk"] = None
+    return targets
+
+
+def build_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(description="Benchmark unfolder rename/repack on synthetic trees.")
+    p.add_argument("--depth", type=int, default=4, help="Directory levels below the root. Default: 4")
+    p.add_argument("--fanout", type=int, default=4, help="Subdirectories per directory. Default: 4")
+    p.add_argument("--files", type=int, default=8, help="Files per directory below the root. Default: 8")
+    p.add_argument("--name-len", type=int, default=8, help="Length of generated names. Default: 8")
+    p.add_argument(
+        "--collision-rate",
+        type=float,
+        default=0.01,
+        help="Share of files whose flattened name already exists at the root. Default: 0.01",
+    )
+    p.add_argument(
+        "--self-dir-rate",
+        type=float,
+        default=0.1,
+        help="Share of top-level directories holding a <name>/<name>.<ext> file. Default: 0.1",
+    )
+    p.add_argument("--seed", type=int, default=0, help="Seed of the tree generator. Default: 0")
+    p.add_argument("--floor", type=int, default=0, help="--floor passed to rename. Default: 0")
+    p.add_argument("--workers", type=int, default=1, help="--workers passed to rename/repack. Default: 1")
+    p.add_argument("--scan-workers", type=int, default=0, help="--scan-workers passed to rename. Default: 0")
+    p.add_argument("--processes", type=int, default=1, help="--processes passed to rename. Default: 1")
+    p.add_argument("--repeat", type=int, default=3, help="Runs per target; the fastest is reported. Default: 3")
+    p.add_argument(
+        "--target",
+        action="append",
+        default=None,
+        metavar="NAME[=DIR]",
+        help="Where to build trees, e.g. tmpfs=/dev/shm or disk=/data/tmp. "
+        "Default: tmpfs (when /dev/shm exists) and the system temp directory.",
+    )
+    p.add_argument(
+        "--startup-repeat",
+        type=int,
+        default=5,
+        help="Fresh interpreters per startup measurement; the fastest is reported. 0 skips them. Default: 5",
+    )
+    p.add_argument("--json", default=None, help="Also write the results to this JSON file.")
+    return p
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    # Per-file log lines are not what is being measured.
+    unfolder.setup_logging("off")
+
+    if args.target:
+        targets = {}
+        for spec in args.target:
+            name, _, path = spec.partition("=")
+            targets[name] = path or None
+    else:
+        targets = _default_targets()
+
+    rows: List[Dict[str, object]] = []
+    for name, base_dir in targets.items():
+        rows.extend(run_target(name, base_dir, args))
+
+    print("%-8s %-10s %8s %9s %12s %13s %8s" % ("target", "op", "files", "seconds", "files/s", "syscalls/file", "restored"))
+    for row in rows:
+        print(
+            "%-8s %-10s %8d %9.3f %12.0f %13.2f %8s"
+            % (
+                row["target"],
+                row["op"],
+                row["files"],
+                row["seconds"],
+                row["files_per_second"],
+                row["syscalls_per_file"],
+                {True: "yes", False: "NO", None: "n/a"}[row["restored"]],
+            )
+        )
+    if args.startup_repeat > 0:
+        startup = measure_startup(args.startup_repeat)
+        print()
+        print("%-28s %9s" % ("startup", "ms"))
+        for row in startup:
+            print("%-28s %9.1f" % (row["op"], row["seconds"] * 1000))
+        rows.extend(startup)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+    if any(row.get("restored") is False for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Randomized consistency checks for the rename library code in unfolder.py.
+
+- _CompactEntries is driven with random inserts, overwrites and forward and
+  reverse lookups, and compared with a plain dict after every step that reads,
+  then saved and loaded again through a compact JsonLibrary.
+- _iter_json_pairs decodes random libraries written with json.dump at every
+  chunk size, and must reject every truncation of them and any value that is
+  not a string.
+- BinaryLibrary files written in one go and rewritten after updates are read
+  back entry by entry, in both directions.
+- Libraries of every available format, in key order or not, are merged into
+  every format, with and without conflicting entries, and the result compared
+  with a reference merge.
+
+Runs are deterministic for a given --seed. Exits with status 1 on the first
+mismatch, after printing it.
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+from typing import Dict, List, Tuple
+
+import unfolder
+
+# Characters that exercise escaping, multi-byte UTF-8, surrogate pairs and the
+# separators of flattened names.
+ALPHABET = "ab_./\\ \"\t\né中😀"
+
+
+def _random_text(rng: random.Random, max_length: int = 12) -> str:
+    return "".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, max_length)))
+
+
+def _random_pairs(rng: random.Random, count: int) -> Dict[str, str]:
+    """Random flattened -> original entries shaped like those rename records."""
+    pairs: Dict[str, str] = {}
+    for _ in range(count):
+        parts = ["d%d" % rng.randint(0, 5) for _ in range(rng.randint(0, 3))]
+        name = "%s%d.jpg" % (_random_text(rng, 4), rng.randint(0, 50))
+        original = "." + os.sep + os.sep.join(parts + [name])
+        pairs["./" + "_".join(parts + [name])] = original
+    return pairs
+
+
+def _check(condition: bool, message: str) -> None:
+    if not condition:
+        raise AssertionError(message)
+
+
+def check_compact_entries(rng: random.Random, trials: int, base_dir: str) -> None:
+    path = os.path.join(base_dir, "compact.json")
+    for trial in range(trials):
+        compact = unfolder._CompactEntries()
+        reference: Dict[str, str] = {}
+        for _ in range(rng.randint(0, 3000)):
+            flattened = "./f%d_é.jpg" % rng.randint(0, 800)
+            original = "./d%d/s%d\\x%d😀.jpg" % (rng.randint(0, 5), rng.randint(0, 3), rng.randint(0, 900))
+            if rng.random() < 0.01:
+                # An original without a directory, and one that is not valid UTF-8.
+                original = rng.choice(("noslash%d" % rng.randint(0, 5), "./a/\udc80bad"))
+            compact[flattened] = original
+            reference[flattened] = original
+            if rng.random() < 0.05:
+                key = "./f%d_é.jpg" % rng.randint(0, 900)
+                _check(compact.get(key) == reference.get(key), "trial %d: get(%r) differs" % (trial, key))
+                _check((key in compact) == (key in reference), "trial %d: %r in differs" % (trial, key))
+                wanted = original if rng.random() < 0.5 else "./d1/s1\\x3😀.jpg"
+                found = compact.get_flattened(wanted)
+                candidates = [key for key, value in reference.items() if value == wanted]
+                _check(
+                    found in candidates if candidates else found is None,
+                    "trial %d: get_flattened(%r) gave %r, expected one of %r" % (trial, wanted, found, candidates),
+                )
+        _check(len(compact) == len(reference), "trial %d: length differs" % trial)
+        _check(list(compact.items()) == list(reference.items()), "trial %d: items differ" % trial)
+        # Saved and loaded again by a compact JsonLibrary. JSON libraries are UTF-8
+        # text, which has no room for undecodable names.
+        storable = {key: value for key, value in reference.items() if "\udc80" not in value}
+        library = unfolder.JsonLibrary(path, load=False, compact=True)
+        library.update(storable.items())
+        library.save()
+        reloaded = unfolder.JsonLibrary(path, compact=True)
+        _check(dict(reloaded.items()) == storable, "trial %d: entries differ once saved and loaded" % trial)
+
+
+def check_json_stream(rng: random.Random, trials: int) -> None:
+    for trial in range(trials):
+        pairs = {_random_text(rng): _random_text(rng) for _ in range(rng.randint(0, 6))}
+        text = json.dumps(
+            pairs,
+            ensure_ascii=rng.random() < 0.5,
+            indent=rng.choice((None, 0, 2)),
+            separators=rng.choice((None, (",", ":"), (" , ", " : "))),
+        )
+        expected = list(pairs.items())
+        for chunk_size in range(1, len(text) + 2):
+            decoded = list(unfolder._iter_json_pairs(io.StringIO(text), chunk_size))
+            _check(decoded == expected, "trial %d, chunk %d: %r decoded as %r" % (trial, chunk_size, text, decoded))
+        for end in range(len(text.rstrip())):
+            try:
+                list(unfolder._iter_json_pairs(io.StringIO(text[:end]), rng.randint(1, 8)))
+            except ValueError:
+                continue
+            raise AssertionError("trial %d: truncated %r was accepted" % (trial, text[:end]))
+        # Anything but a flat object of strings is not a library.
+        value = rng.choice((1, None, True, [], {}, ["a"], {"a": "b"}))
+        text = json.dumps(dict(pairs, **{_random_text(rng): value}) if rng.random() < 0.8 else [pairs])
+        try:
+            list(unfolder._iter_json_pairs(io.StringIO(text), rng.randint(1, 8)))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("trial %d: %r was accepted" % (trial, text))
+
+
+def check_binary_library(rng: random.Random, trials: int, base_dir: str) -> None:
+    path = os.path.join(base_dir, "binary.lib")
+    for trial in range(trials):
+        reference = _random_pairs(rng, rng.choice((0, 1, rng.randint(2, 2000))))
+        unfolder.BinaryLibrary.write(path, sorted(reference.items()))
+        for step in ("written", "updated"):
+            library = unfolder.BinaryLibrary(path)
+            try:
+                _check(len(library) == len(reference), "trial %d, %s: length differs" % (trial, step))
+                _check(
+                    dict(library.items()) == reference, "trial %d, %s: items differ" % (trial, step)
+                )
+                for flattened, original in reference.items():
+                    _check(library.get(flattened) == original, "trial %d, %s: get(%r)" % (trial, step, flattened))
+                    _check(
+                        library.get_flattened(original) is not None,
+                        "trial %d, %s: get_flattened(%r)" % (trial, step, original),
+                    )
+                _check(library.get("./missing.jpg") is None, "trial %d, %s: missing key found" % (trial, step))
+                if step == "written":
+                    updates = _random_pairs(rng, rng.randint(0, 200))
+                    for flattened in rng.sample(sorted(reference), min(len(reference), 20)):
+                        updates[flattened] = "." + os.sep + "moved" + os.sep + _random_text(rng, 4) + ".jpg"
+                    for flattened, original in updates.items():
+                        library[flattened] = original
+                    reference.update(updates)
+                    library.save()
+            finally:
+                library.close()
+
+
+def _available_formats() -> List[str]:
+    formats = []
+    for fmt, cls in sorted(unfolder.LIBRARY_FORMATS.items()):
+        try:
+            cls.check_available()
+        except ImportError:
+            continue
+        formats.append(fmt)
+    return formats
+
+
+def check_merge(rng: random.Random, trials: int, base_dir: str) -> None:
+    formats = _available_formats()
+    for trial in range(trials):
+        # Small runs make unsorted JSON inputs spill to temporary files.
+        unfolder.SORT_RUN_ENTRIES = rng.choice((3, 50, 1 << 18))
+        shared = _random_pairs(rng, rng.randint(0, 300))
+        inputs: List[Tuple[str, Dict[str, str]]] = []
+        for i in range(rng.randint(1, 4)):
+            part = {key: value for key, value in shared.items() if rng.random() < 0.5}
+            part.update(_random_pairs(rng, rng.randint(0, 100)))
+            fmt = rng.choice(formats)
+            path = os.path.join(base_dir, "in-%d.%s" % (i, fmt))
+            pairs = sorted(part.items())
+            if fmt != unfolder.BinaryLibrary.format and rng.random() < 0.5:
+                # In walk order, as rename leaves them, rather than key order.
+                rng.shuffle(pairs)
+            unfolder.LIBRARY_FORMATS[fmt].write(path, pairs)
+            inputs.append((path, part))
+
+        first: Dict[str, str] = {}
+        last: Dict[str, str] = {}
+        for _, part in inputs:
+            for key, value in part.items():
+                first.setdefault(key, value)
+                last[key] = value
+        conflicts = sum(1 for key in last if first[key] != last[key])
+
+        paths = [path for path, _ in inputs]
+        for fmt in formats:
+            output = os.path.join(base_dir, "out.%s" % fmt)
+            for policy, expected in (("first", first), ("last", last)):
+                entries, found = unfolder.merge_libraries(paths, output, fmt, policy)
+                _check(
+                    (entries, found) == (len(expected), conflicts),
+                    "trial %d, %s/%s: merge reported %r" % (trial, fmt, policy, (entries, found)),
+                )
+                library = unfolder.open_library(output)
+                try:
+                    _check(
+                        list(library.sorted_items()) == sorted(expected.items()),
+                        "trial %d, %s/%s: merged entries differ" % (trial, fmt, policy),
+                    )
+                finally:
+                    library.close()
+            os.remove(output)
+            try:
+                unfolder.merge_libraries(paths, output, fmt, "fail")
+            except ValueError:
+                _check(conflicts > 0, "trial %d, %s: merge failed without conflicts" % (trial, fmt))
+                _check(not os.path.exists(output), "trial %d, %s: failed merge wrote output" % (trial, fmt))
+            else:
+                _check(conflicts == 0, "trial %d, %s: conflicts were not reported" % (trial, fmt))
+        for path in paths:
+            os.remove(path)
+
+
+CHECKS = ("compact", "json-stream", "binary", "merge")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(description="Randomized consistency checks for unfolder.py rename libraries.")
+    p.add_argument("--seed", type=int, default=1, help="Random seed. Default: 1")
+    p.add_argument("--trials", type=int, default=20, help="Random cases per check. Default: 20")
+    p.add_argument("--only", choices=CHECKS, action="append", help="Run only this check; may be repeated.")
+    return p
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    # Conflicts reported by the merges are expected.
+    unfolder.setup_logging("off")
+    base_dir = tempfile.mkdtemp(prefix="unfolder-check-")
+    checks = {
+        "compact": lambda rng: check_compact_entries(rng, args.trials, base_dir),
+        "json-stream": lambda rng: check_json_stream(rng, args.trials),
+        "binary": lambda rng: check_binary_library(rng, args.trials, base_dir),
+        "merge": lambda rng: check_merge(rng, args.trials, base_dir),
+    }
+    try:
+        for name in args.only or CHECKS:
+            try:
+                checks[name](random.Random("%d-%s" % (args.seed, name)))
+            except AssertionError as exc:
+                print("%-12s FAILED: %s" % (name, exc))
+                sys.exit(1)
+            print("%-12s ok" % name)
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Crash-recovery round trips for unfolder.py "rename" and "repack".
+
+Each check generates a synthetic tree (see benchmark.generate_tree), runs rename
+in a child process that is SIGKILLed, worker processes and all, at a random point,
+recovers with further runs and finally repacks, and then compares the tree with
+the one it started from:
+
+- killed-rename: the child dies just before or just after one of its renames,
+  and a plain rerun of rename picks up what the journal recorded.
+- lost-journal: as killed-rename, but the journal is deleted too, as if its
+  unsynced tail had been lost with the machine; the rerun, with or without
+  --resume, has only the rename checkpoint to go by.
+- repack-after-kill: repack runs straight after the killed rename, possibly with
+  no library to go by, and must leave the files of the interrupted run alone;
+  a full rename and repack then have to restore the tree.
+- killed-shards: a rename with --processes dies in one of its workers; the
+  shard libraries and journals it leaves are recovered by either a plain rerun
+  of rename or straight by repack.
+
+Runs are deterministic for a given --seed, up to the scheduling of the child.
+Exits with status 1 on the first mismatch, after printing it.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+from typing import List
+
+from benchmark import _snapshot, generate_tree
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Installed as sitecustomize for a run that is to be killed, so that it is also
+# loaded by the worker processes of --processes. Around rename call `after` of
+# any one process it SIGKILLs the run's whole process group.
+KILL_HOOK = """
+import itertools, os, signal
+
+import unfolder
+
+after = int(os.environ["UNFOLDER_KILL_AFTER"])
+when = os.environ["UNFOLDER_KILL_WHEN"]
+# next() on a count is atomic, so renames on several threads each get their own number.
+calls = itertools.count(1)
+rename = unfolder._rename_noreplace
+
+
+def _rename_then_die(src, dst):
+    call = next(calls)
+    if call == after and when == "before":
+        os.killpg(0, signal.SIGKILL)
+    rename(src, dst)
+    if call == after and when == "after":
+        os.killpg(0, signal.SIGKILL)
+
+
+unfolder._rename_noreplace = _rename_then_die
+"""
+
+
+def _check(condition: bool, message: str) -> None:
+    if not condition:
+        raise AssertionError(message)
+
+
+def _run(argv: List[str]) -> None:
+    """Run unfolder in a fresh process and require it to succeed."""
+    proc = subprocess.run(
+        [sys.executable, os.path.join(HERE, "unfolder.py")] + argv + ["--log-mode", "off"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    _check(proc.returncode == 0, "%s failed:\n%s" % (" ".join(argv), proc.stdout.decode(errors="replace")))
+
+
+def _run_killed(after: int, when: str, argv: List[str], base_dir: str) -> None:
+    """Run unfolder in a child that is killed around the `after`-th rename of one of its processes."""
+    hook_dir = os.path.join(base_dir, "hook")
+    if not os.path.exists(hook_dir):
+        os.mkdir(hook_dir)
+        with open(os.path.join(hook_dir, "sitecustomize.py"), "w", encoding="utf-8") as f:
+            f.write(KILL_HOOK)
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([hook_dir, HERE]),
+        UNFOLDER_KILL_AFTER=str(after),
+        UNFOLDER_KILL_WHEN=when,
+    )
+    # Run through "import unfolder" rather than as a script, so the hook patches
+    # the module the run uses; its own session keeps the kill away from this process.
+    proc = subprocess.run(
+        [sys.executable, "-c", "import sys, unfolder; unfolder.main(sys.argv[1:])"] + argv + ["--log-mode", "off"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        env=env,
+        start_new_session=True,
+    )
+    _check(
+        proc.returncode == -signal.SIGKILL,
+        "%s was not killed (status %d):\n%s" % (" ".join(argv), proc.returncode, proc.stdout.decode(errors="replace")),
+    )
+
+
+def _make_tree(rng: random.Random, root: str) -> int:
+    return generate_tree(
+        root,
+        depth=3,
+        fanout=3,
+        files=rng.randint(2, 8),
+        name_len=6,
+        collision_rate=0.05,
+        self_dir_rate=0.3,
+        seed=rng.randint(0, 1 << 30),
+    )
+
+
+def check_killed_rename(rng: random.Random, trials: int, base_dir: str) -> None:
+    for trial in range(trials):
+        root = os.path.join(base_dir, "tree-%d" % trial)
+        files = _make_tree(rng, root)
+        before = _snapshot(root)
+        args = ["--dir", root, "--workers", str(rng.choice((1, 4)))]
+        when = rng.choice(("before", "after"))
+        after = rng.randint(1, files // 2)
+        _run_killed(after, when, ["rename"] + args, base_dir)
+        _run(["rename"] + args)
+        _run(["repack", "--dir", root])
+        after_round_trip = _snapshot(root)
+        _check(
+            after_round_trip == before,
+            "trial %d, killed %s rename %d: tree differs after the round trip: %s"
+            % (trial, when, after, sorted(set(before) ^ set(after_round_trip))[:10]),
+        )
+        shutil.rmtree(root)
+
+
+def check_lost_journal(rng: random.Random, trials: int, base_dir: str) -> None:
+    for trial in range(trials):
+        root = os.path.join(base_dir, "tree-%d" % trial)
+        files = _make_tree(rng, root)
+        before = _snapshot(root)
+        args = ["--dir", root, "--workers", str(rng.choice((1, 4)))]
+        after = rng.randint(1, files // 2)
+        _run_killed(after, "after", ["rename"] + args, base_dir)
+        os.remove(os.path.join(root, ".rename_lib.journal"))
+        resume = rng.random() < 0.5
+        _run(["rename"] + args + (["--resume"] if resume else []))
+        _run(["repack", "--dir", root])
+        after_round_trip = _snapshot(root)
+        _check(
+            after_round_trip == before,
+            "trial %d, killed after rename %d, rerun %s --resume: tree differs after the round trip: %s"
+            % (trial, after, "with" if resume else "without", sorted(set(before) ^ set(after_round_trip))[:10]),
+        )
+        shutil.rmtree(root)
+
+
+def check_repack_after_kill(rng: random.Random, trials: int, base_dir: str) -> None:
+    for trial in range(trials):
+        root = os.path.join(base_dir, "tree-%d" % trial)
+        files = _make_tree(rng, root)
+        before = _snapshot(root)
+        # Killed before its first rename, the run leaves no library entry at all
+        # and repack falls back to the classic method.
+        after = rng.choice((1, rng.randint(1, files // 2)))
+        when = rng.choice(("before", "after"))
+        _run_killed(after, when, ["rename", "--dir", root], base_dir)
+        _run(["repack", "--dir", root])
+        _run(["rename", "--dir", root])
+        _run(["repack", "--dir", root])
+        after_round_trip = _snapshot(root)
+        _check(
+            after_round_trip == before,
+            "trial %d, killed %s rename %d: tree differs after the round trip: %s"
+            % (trial, when, after, sorted(set(before) ^ set(after_round_trip))[:10]),
+        )
+        shutil.rmtree(root)
+
+
+def check_killed_shards(rng: random.Random, trials: int, base_dir: str) -> None:
+    for trial in range(trials):
+        root = os.path.join(base_dir, "tree-%d" % trial)
+        files = _make_tree(rng, root)
+        before = _snapshot(root)
+        # Every worker renames about a third of the files; one of them has to get this far.
+        after = rng.randint(1, max(1, files // 8))
+        when = rng.choice(("before", "after"))
+        _run_killed(after, when, ["rename", "--dir", root, "--processes", "3"], base_dir)
+        rerun = rng.random() < 0.5
+        if rerun:
+            _run(["rename", "--dir", root])
+        _run(["repack", "--dir", root])
+        after_round_trip = _snapshot(root)
+        _check(
+            after_round_trip == before,
+            "trial %d, killed %s rename %d, %s: tree differs after the round trip: %s"
+            % (
+                trial,
+                when,
+                after,
+                "rename rerun" if rerun else "repacked at once",
+                sorted(set(before) ^ set(after_round_trip))[:10],
+            ),
+        )
+        shutil.rmtree(root)
+
+
+CHECKS = ("killed-rename", "lost-journal", "repack-after-kill", "killed-shards")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(description="Crash-recovery round trips for unfolder.py rename and repack.")
+    p.add_argument("--seed", type=int, default=1, help="Random seed. Default: 1")
+    p.add_argument("--trials", type=int, default=10, help="Random cases per check. Default: 10")
+    p.add_argument("--only", choices=CHECKS, action="append", help="Run only this check; may be repeated.")
+    return p
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    base_dir = tempfile.mkdtemp(prefix="unfolder-recovery-")
+    checks = {
+        "killed-rename": lambda rng: check_killed_rename(rng, args.trials, base_dir),
+        "lost-journal": lambda rng: check_lost_journal(rng, args.trials, base_dir),
+        "repack-after-kill": lambda rng: check_repack_after_kill(rng, args.trials, base_dir),
+        "killed-shards": lambda rng: check_killed_shards(rng, args.trials, base_dir),
+    }
+    try:
+        for name in args.only or CHECKS:
+            try:
+                checks[name](random.Random("%d-%s" % (args.seed, name)))
+            except AssertionError as exc:
+                print("%-18s FAILED: %s" % (name, exc))
+                sys.exit(1)
+            print("%-18s ok" % name)
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
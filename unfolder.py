@@ -7,6 +7,10 @@ Refactored from the original rename.py and repack.py without changing core logic
 - Subcommands:
   * rename: replicate original rename.py behavior (using .rename_lib)
   * repack: replicate original repack.py behavior (classic or using .rename_lib)
+- Library API for in-process use: rename() and repack() return RenameResult /
+  RepackResult; Planner, Executor and RenameLibrary expose the individual steps.
+  Roots are explicit and the working directory is never changed, so calls on
+  different roots can run on separate threads.
 
 Notes on behavior preservation:
 - The core renaming/restoring algorithms are kept intact, including the quirky path handling.
@@ -16,91 +20,2798 @@ Notes on behavior preservation:
 """
 
 import argparse
+import bisect
+import errno
+import io
 import json
 import os
+import struct
 import sys
-from typing import Dict, Optional
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, BinaryIO, Callable, Deque, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
 
-from loguru import logger
+if TYPE_CHECKING:
+    from concurrent.futures import Future
 
 
-def setup_logging():
-    logger.remove()
-    logger.add(sys.stdout, level="INFO", format="{message}")
+LOG_MODES = ("per-file", "batched", "summary", "off")
+LOG_BATCH_INTERVAL = 0.2
+LOG_BATCH_LINES = 4096
 
 
-def _rename_walk(
+class _BatchedWriter:
+    """
+    Loguru sink buffering messages in memory; a background thread writes them
+    out in one call every LOG_BATCH_INTERVAL seconds, or sooner once
+    LOG_BATCH_LINES are pending. Callers never wait on a slow terminal or pipe
+    beyond taking the buffer lock.
+    """
+
+    def __init__(self, stream: TextIO):
+        self._stream = stream
+        self._pending: List[str] = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, message: str) -> None:
+        with self._lock:
+            self._pending.append(message)
+            full = len(self._pending) >= LOG_BATCH_LINES
+        if full:
+            self._wake.set()
+
+    def _flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if pending:
+            self._stream.write("".join(pending))
+            self._stream.flush()
+
+    def _run(self) -> None:
+        while not self._closed:
+            self._wake.wait(LOG_BATCH_INTERVAL)
+            self._wake.clear()
+            self._flush()
+
+    def flush(self) -> None:
+        # Called by logging.StreamHandler after every record; flushing is the
+        # background thread's job.
+        pass
+
+    def close(self) -> None:
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        self._flush()
+
+
+def _import_loguru():
+    try:
+        from loguru import logger as loguru_logger
+    except ImportError:
+        return None
+    return loguru_logger
+
+
+def _stdlib_logger(stream: TextIO):
+    import logging
+
+    log = logging.getLogger("unfolder")
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    return log
+
+
+class _Logger:
+    """
+    Forwards to the backend picked by setup_logging. Until then it forwards to
+    loguru's own logger, or to stdlib logging without loguru, importing either
+    on first use so that merely importing this module (or --help) stays cheap.
+    """
+
+    def _target(self):
+        global _log_backend
+        if _log_backend is None:
+            _log_backend = _import_loguru() or _stdlib_logger(sys.stderr)
+        return _log_backend
+
+    def info(self, message: str) -> None:
+        self._target().info(message)
+
+    def warning(self, message: str) -> None:
+        self._target().warning(message)
+
+    def error(self, message: str) -> None:
+        self._target().error(message)
+
+
+logger = _Logger()
+_log_backend = None
+_log_mode = "per-file"
+_log_writer: Optional[_BatchedWriter] = None
+_log_counts: Dict[str, int] = {}
+_log_counts_lock = threading.Lock()
+
+
+def _route_logging(stream: TextIO, use_loguru: bool) -> None:
+    global _log_backend
+    loguru_logger = _import_loguru() if use_loguru else None
+    if loguru_logger is None:
+        _log_backend = _stdlib_logger(stream)
+        return
+    loguru_logger.remove()
+    loguru_logger.add(stream if stream is sys.stdout else stream.write, level="INFO", format="{message}")
+    _log_backend = loguru_logger
+
+
+def setup_logging(mode: str = "per-file"):
+    """
+    Route log output to stdout. The mode only concerns the per-file lines
+    emitted through _log_file:
+
+    - per-file: every line is written as it happens (the original behavior);
+    - batched: lines are buffered and written by a background thread;
+    - summary: per-file lines are only counted, and totals printed at the end;
+    - off: per-file lines are dropped.
+
+    loguru is only imported for the modes that write per-file lines; the few
+    run-level messages of summary and off go through stdlib logging, as does
+    everything when loguru is not installed.
+    """
+    global _log_mode, _log_writer
+    if mode not in LOG_MODES:
+        raise ValueError("Unknown log mode %r; expected one of %s." % (mode, ", ".join(LOG_MODES)))
+    shutdown_logging()
+    use_loguru = mode in ("per-file", "batched")
+    if mode == "batched":
+        _log_writer = _BatchedWriter(sys.stdout)
+        _route_logging(_log_writer, use_loguru)
+    else:
+        _route_logging(sys.stdout, use_loguru)
+    _log_mode = mode
+    with _log_counts_lock:
+        _log_counts.clear()
+
+
+def shutdown_logging():
+    """Flush batched output and print the totals of summary mode."""
+    global _log_writer
+    if _log_writer is not None:
+        writer, _log_writer = _log_writer, None
+        _route_logging(sys.stdout, use_loguru=True)
+        writer.close()
+    if _log_mode == "summary":
+        with _log_counts_lock:
+            counts = sorted(_log_counts.items())
+            _log_counts.clear()
+        for event, n in counts:
+            logger.info("%s: %d file(s)." % (event, n))
+
+
+def _take_log_counts() -> Dict[str, int]:
+    """Remove and return the summary-mode counts gathered so far."""
+    with _log_counts_lock:
+        counts = dict(_log_counts)
+        _log_counts.clear()
+    return counts
+
+
+def _add_log_counts(counts: Dict[str, int]) -> None:
+    """Add summary-mode counts gathered in another process."""
+    with _log_counts_lock:
+        for event, n in counts.items():
+            _log_counts[event] = _log_counts.get(event, 0) + n
+
+
+def _log_file(event: str, template: str, *args) -> None:
+    """
+    Log one per-file line. event names the outcome for summary mode; the line is
+    only formatted when it is going to be written.
+    """
+    mode = _log_mode
+    if mode == "off":
+        return
+    if mode == "summary":
+        with _log_counts_lock:
+            _log_counts[event] = _log_counts.get(event, 0) + 1
+        return
+    logger.info(template % args)
+
+
+# Upper bounds in seconds of the latency histograms.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+class _Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self) -> None:
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.total += value
+        self.count += 1
+
+
+class _RunStats:
+    """
+    Wall time per phase, event counters and latency histograms of one run,
+    reported by --stats and --metrics-file.
+
+    Disabled by default, in which case counting is a single attribute check.
+    Counters may be bumped from the scanner and executor threads.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.phases: Dict[str, float] = {}
+        self.counters: Dict[str, int] = {}
+        self.histograms: Dict[str, _Histogram] = {}
+        # Phase in progress with its start time, and the work it expects to do.
+        self.current: Optional[Tuple[str, float]] = None
+        self.expected = 0
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self.start_time = time.time()
+
+    def enable(self) -> None:
+        self.enabled = True
+        self.phases.clear()
+        self.counters.clear()
+        self.histograms.clear()
+        self.current = None
+        self.expected = 0
+        self._started = time.perf_counter()
+        self.start_time = time.time()
+
+    def expect(self, n: int) -> None:
+        """Announce how many operations the current phase is going to run."""
+        self.expected = n
+
+    def count(self, name: str, n: int = 1) -> None:
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name: str, seconds: float) -> None:
+        if self.enabled:
+            with self._lock:
+                hist = self.histograms.get(name)
+                if hist is None:
+                    hist = self.histograms[name] = _Histogram()
+                hist.observe(seconds)
+
+    @contextmanager
+    def phase(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        self.current = (name, start)
+        self.expected = 0
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.current = None
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def snapshot(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "wall_time": time.perf_counter() - self._started,
+                "phases": dict(self.phases),
+                "counters": dict(sorted(self.counters.items())),
+                "histograms": {
+                    name: {
+                        "buckets": dict(zip(LATENCY_BUCKETS, hist.counts)),
+                        "sum": hist.total,
+                        "count": hist.count,
+                    }
+                    for name, hist in sorted(self.histograms.items())
+                },
+            }
+
+    def merge(self, data: Dict[str, object]) -> None:
+        """Add a snapshot taken in another process, e.g. a batch worker."""
+        if not self.enabled:
+            return
+        with self._lock:
+            for name, seconds in data["phases"].items():
+                self.phases[name] = self.phases.get(name, 0.0) + seconds
+            for name, value in data["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, other in data["histograms"].items():
+                hist = self.histograms.get(name)
+                if hist is None:
+                    hist = self.histograms[name] = _Histogram()
+                for i, n in enumerate(other["buckets"].values()):
+                    hist.counts[i] += n
+                hist.total += other["sum"]
+                hist.count += other["count"]
+
+    def report(self, dest: str) -> None:
+        """Write the summary to stderr when dest is "-", otherwise as JSON to dest."""
+        data = self.snapshot()
+        if dest != "-":
+            with open(dest, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=2)
+            return
+        lines = ["Run statistics:", "  %-24s %10.3fs" % ("wall time", data["wall_time"])]
+        for name, seconds in data["phases"].items():
+            lines.append("  %-24s %10.3fs" % ("phase " + name, seconds))
+        for name, value in data["counters"].items():
+            lines.append("  %-24s %11d" % (name, value))
+        for name, hist in data["histograms"].items():
+            mean = hist["sum"] / hist["count"] if hist["count"] else 0.0
+            lines.append("  %-24s %10.6fs mean of %d" % (name, mean, hist["count"]))
+        sys.stderr.write("\n".join(lines) + "\n")
+
+
+_stats = _RunStats()
+
+PROGRESS_INTERVAL = 0.25
+
+
+def _format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class _ProgressReporter:
+    """
+    Status line on a terminal, redrawn every PROGRESS_INTERVAL seconds from the
+    run counters. The walk and the workers only bump counters; all formatting
+    happens on the reporter thread.
+    """
+
+    def __init__(self, stream: TextIO, interval: float = PROGRESS_INTERVAL):
+        self._stream = stream
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(interval,), daemon=True)
+        self._thread.start()
+
+    def _line(self) -> Optional[str]:
+        current = _stats.current
+        if current is None:
+            return None
+        name, since = current
+        elapsed = max(time.perf_counter() - since, 1e-9)
+        counters = _stats.snapshot()["counters"]
+        if name == "plan":
+            dirs = counters.get("dirs_visited", 0)
+            files = counters.get("files_scanned", 0)
+            return "Planning: %d dirs (%.0f dirs/s), %d files (%.0f files/s)" % (
+                dirs,
+                dirs / elapsed,
+                files,
+                files / elapsed,
+            )
+        if name == "rename":
+            done = counters.get("renames_attempted", 0)
+            rate = done / elapsed
+            total = _stats.expected
+            if total and rate:
+                eta = "ETA %s" % _format_duration((total - done) / rate)
+            else:
+                eta = "ETA --:--:--"
+            return "Renaming: %d/%d files (%.1f%%), %.0f files/s, %s" % (
+                done,
+                total,
+                100.0 * done / total if total else 100.0,
+                rate,
+                eta,
+            )
+        if name == "rmdir":
+            dirs = counters.get("syscalls.rmdir", 0)
+            return "Removing directories: %d dirs (%.0f dirs/s)" % (dirs, dirs / elapsed)
+        return "%s: %s" % (name.replace("_", " ").capitalize(), _format_duration(elapsed))
+
+    def _run(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            line = self._line()
+            if line is not None:
+                self._stream.write("\r\x1b[K" + line)
+                self._stream.flush()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self._stream.write("\r\x1b[K")
+        self._stream.flush()
+
+METRICS_INTERVAL = 15.0
+
+_METRIC_HELP = {
+    "collisions": "Files skipped because their destination name already exists.",
+    "dirs_visited": "Directories listed by the rename walk.",
+    "files_scanned": "Directory entries examined.",
+    "journal.records": "Mappings appended to the rename journal.",
+    "library.bytes_read": "Bytes of rename library read.",
+    "library.bytes_written": "Bytes of rename library written.",
+    "renames_done": "Files renamed.",
+    "renames_skipped": "Files skipped because the library already records them.",
+    "rename_seconds": "Latency of a single rename.",
+}
+
+
+def _metric_name(name: str) -> str:
+    return "unfolder_" + name.replace(".", "_")
+
+
+def _format_metrics(command: str, data: Dict[str, object], start_time: float, finished: bool) -> str:
+    """
+    Render a stats snapshot in the Prometheus text format read by node_exporter's
+    textfile collector. Counters are declared under their "_total" sample names,
+    which that format requires for samples to keep their type.
+    """
+    label = 'command="%s"' % command
+    out: List[str] = []
+
+    def _family(name: str, kind: str, help_text: str) -> None:
+        out.append("# TYPE %s %s" % (name, kind))
+        out.append("# HELP %s %s" % (name, help_text))
+
+    _family("unfolder_run_start_time_seconds", "gauge", "Unix time the run started.")
+    out.append("unfolder_run_start_time_seconds{%s} %.3f" % (label, start_time))
+    _family("unfolder_run_finished", "gauge", "1 once the run has ended, 0 while it is in progress.")
+    out.append("unfolder_run_finished{%s} %d" % (label, finished))
+    _family("unfolder_run_duration_seconds", "gauge", "Wall time of the run so far.")
+    out.append("unfolder_run_duration_seconds{%s} %.6f" % (label, data["wall_time"]))
+
+    counters: Dict[str, int] = data["counters"]
+    wall_time: float = data["wall_time"]
+    _family("unfolder_files_per_second", "gauge", "Completed renames per second of wall time.")
+    done = counters.get("renames_done", 0)
+    out.append("unfolder_files_per_second{%s} %.3f" % (label, done / wall_time if wall_time else 0.0))
+
+    _family("unfolder_phase_duration_seconds", "gauge", "Wall time spent in each phase.")
+    for phase, seconds in data["phases"].items():
+        out.append('unfolder_phase_duration_seconds{%s,phase="%s"} %.6f' % (label, phase, seconds))
+
+    syscalls = {name[len("syscalls."):]: value for name, value in counters.items() if name.startswith("syscalls.")}
+    if syscalls:
+        _family("unfolder_syscalls_total", "counter", "Filesystem calls issued, by call.")
+        for call, value in syscalls.items():
+            out.append('unfolder_syscalls_total{%s,call="%s"} %d' % (label, call, value))
+    for name, value in counters.items():
+        if name.startswith("syscalls."):
+            continue
+        metric = _metric_name(name) + "_total"
+        _family(metric, "counter", _METRIC_HELP.get(name, name))
+        out.append("%s{%s} %d" % (metric, label, value))
+
+    for name, hist in data["histograms"].items():
+        metric = _metric_name(name)
+        _family(metric, "histogram", _METRIC_HELP.get(name, name))
+        cumulative = 0
+        for bound, n in hist["buckets"].items():
+            cumulative += n
+            out.append('%s_bucket{%s,le="%s"} %d' % (metric, label, bound, cumulative))
+        out.append('%s_bucket{%s,le="+Inf"} %d' % (metric, label, hist["count"]))
+        out.append("%s_sum{%s} %.6f" % (metric, label, hist["sum"]))
+        out.append("%s_count{%s} %d" % (metric, label, hist["count"]))
+    return "\n".join(out) + "\n"
+
+
+class _MetricsWriter:
+    """
+    Rewrites a Prometheus textfile every METRICS_INTERVAL seconds while the run
+    lasts, and once more at the end. Each write replaces the file atomically, so a
+    scraper never sees a half-written one.
+    """
+
+    def __init__(self, path: str, command: str, interval: float = METRICS_INTERVAL):
+        self.path = path
+        self.command = command
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(interval,), daemon=True)
+        self._thread.start()
+
+    def _run(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            try:
+                self.write(False)
+            except OSError as exc:
+                logger.warning("Unable to write metrics file %s: %s" % (self.path, exc))
+
+    def write(self, finished: bool) -> None:
+        text = _format_metrics(self.command, _stats.snapshot(), _stats.start_time, finished)
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, self.path)
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.write(True)
+
+
+AT_FDCWD = -100
+RENAME_NOREPLACE = 1
+
+# None: not resolved yet; False: unavailable on this platform or kernel.
+_renameat2 = None
+
+
+def _get_renameat2():
+    global _renameat2
+    if _renameat2 is None:
+        _renameat2 = False
+        if sys.platform.startswith("linux"):
+            try:
+                import ctypes
+
+                libc = ctypes.CDLL(None, use_errno=True)
+                fn = libc.renameat2
+            except (OSError, AttributeError):
+                pass
+            else:
+                fn.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+                fn.restype = ctypes.c_int
+                _renameat2 = fn
+    return _renameat2 or None
+
+
+# Directory-relative *at() calls let the kernel resolve one path component per
+# operation instead of the full path. Not available on Windows.
+_DIR_FD_SUPPORTED = {os.open, os.rename, os.rmdir, os.stat} <= os.supports_dir_fd
+_DIR_FD_CACHE_SIZE = 64
+# The walk keeps one descriptor open per level of the current path; deeper
+# levels are listed by path so that deep trees stay well below the fd limit.
+_DIR_FD_DEPTH = 128
+_dir_fds = threading.local()
+
+
+def _open_dir(path: str, dir_fd: Optional[int] = None) -> int:
+    _stats.count("syscalls.open")
+    return os.open(path, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0), dir_fd=dir_fd)
+
+
+def _split_dir_fd(path: str) -> Tuple[Optional[int], str]:
+    """
+    Split path into (descriptor of its parent directory, final component).
+
+    Descriptors come from a small per-thread LRU cache, so files sharing a directory
+    share one open. Returns (None, path) where dir_fd is unsupported.
+    """
+    if not _DIR_FD_SUPPORTED:
+        return None, path
+    dir_path, name = os.path.split(path)
+    dir_path = dir_path or "."
+    cache = getattr(_dir_fds, "cache", None)
+    if cache is None:
+        cache = _dir_fds.cache = OrderedDict()
+    fd = cache.get(dir_path)
+    if fd is None:
+        fd = _open_dir(dir_path)
+        cache[dir_path] = fd
+        if len(cache) > _DIR_FD_CACHE_SIZE:
+            os.close(cache.popitem(last=False)[1])
+    else:
+        cache.move_to_end(dir_path)
+    return fd, name
+
+
+def _close_dir_fds() -> None:
+    cache = getattr(_dir_fds, "cache", None)
+    if cache:
+        for fd in cache.values():
+            os.close(fd)
+        cache.clear()
+
+
+def _rename_noreplace(src: str, dst: str) -> None:
+    """
+    Rename src to dst, raising FileExistsError instead of replacing an existing dst.
+
+    On Linux this is a single renameat2(RENAME_NOREPLACE) call, so the collision check
+    is atomic. Windows' rename never replaces an existing file. Elsewhere, and on
+    filesystems that reject the flag, fall back to checking before renaming.
+    """
+    global _renameat2
+    src_fd, src_name = _split_dir_fd(src)
+    dst_fd, dst_name = _split_dir_fd(dst)
+    fn = _get_renameat2()
+    if fn is not None:
+        import ctypes
+
+        _stats.count("syscalls.rename")
+        if (
+            fn(
+                AT_FDCWD if src_fd is None else src_fd,
+                os.fsencode(src_name),
+                AT_FDCWD if dst_fd is None else dst_fd,
+                os.fsencode(dst_name),
+                RENAME_NOREPLACE,
+            )
+            == 0
+        ):
+            return
+        err = ctypes.get_errno()
+        if err == errno.ENOSYS:
+            _renameat2 = False
+        elif err != errno.EINVAL:
+            raise OSError(err, os.strerror(err), src, None, dst)
+    elif os.name == "nt":
+        _stats.count("syscalls.rename")
+        os.rename(src, dst)
+        return
+    _stats.count("syscalls.stat")
+    try:
+        os.stat(dst_name, dir_fd=dst_fd, follow_symlinks=False)
+    except FileNotFoundError:
+        _stats.count("syscalls.rename")
+        os.rename(src_name, dst_name, src_dir_fd=src_fd, dst_dir_fd=dst_fd)
+    else:
+        raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), src, None, dst)
+
+
+def _flatten_name(path: str, head: int, collapse_self_dir: bool) -> str:
+    relative_path = path[head:]
+    new_name = path[:head] + relative_path.replace("\\", "_").replace("/", "_")
+    if collapse_self_dir:
+        normalized_rel = relative_path.replace("\\", "/")
+        if normalized_rel.count("/") == 1:
+            parent_candidate, file_part = normalized_rel.split("/", 1)
+            file_stem, file_ext = os.path.splitext(file_part)
+            if file_stem == parent_candidate:
+                new_name = path[:head] + file_stem + file_ext
+    return new_name
+
+
+def _list_dir(dir_path) -> List[os.DirEntry]:
+    _stats.count("syscalls.scandir")
+    with os.scandir(dir_path) as it:
+        entries = list(it)
+    # Warm the DirEntry type cache while still on the scanning thread, and while a
+    # directory descriptor passed in is still open.
+    for entry in entries:
+        entry.is_file()
+        entry.is_symlink()
+    return entries
+
+
+class _PrefetchScanner:
+    """
+    Lists directories on a bounded thread pool ahead of the walk.
+
+    The walk still consumes listings one directory at a time in depth-first order,
+    so decisions and output order are the same as a serial walk. Whenever a listing
+    is handed out, its first `lookahead` subdirectories (default: twice the number
+    of workers) are queued for listing, and each time one of them is handed out in
+    turn the next of its siblings is queued. At most `lookahead` listings per level
+    of the current walk path are thus outstanding or held, however wide the tree.
+    Paths are resolved against root.
+    """
+
+    def __init__(self, workers: int, root: str = "", lookahead: int = 0):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scan")
+        self._pending: Dict[str, "Future[List[os.DirEntry]]"] = {}
+        # Subdirectories not queued yet, in listing order, by parent directory.
+        self._waiting: Dict[str, Deque[str]] = {}
+        self._root = root
+        self._lookahead = lookahead or 2 * workers
+
+    def _submit(self, dir_path: str) -> None:
+        self._pending[dir_path] = self._pool.submit(_list_dir, os.path.join(self._root, dir_path))
+
+    def scan(self, dir_path: str) -> List[os.DirEntry]:
+        parent = dir_path.rpartition(os.sep)[0]
+        waiting = self._waiting.get(parent)
+        future = self._pending.pop(dir_path, None)
+        if future is None:
+            if waiting and dir_path in waiting:
+                waiting.remove(dir_path)
+            future = self._pool.submit(_list_dir, os.path.join(self._root, dir_path))
+        elif waiting:
+            self._submit(waiting.popleft())
+        if waiting is not None and not waiting:
+            del self._waiting[parent]
+        entries = future.result()
+        children = deque(_entry_path(dir_path, entry) for entry in entries if not entry.is_file())
+        for _ in range(min(self._lookahead, len(children))):
+            self._submit(children.popleft())
+        if children:
+            self._waiting[dir_path] = children
+        return entries
+
+    def close(self) -> None:
+        self._pending.clear()
+        self._waiting.clear()
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+
+JOURNAL_SYNC_OPS = 1000
+JOURNAL_SYNC_INTERVAL = 1.0
+
+
+def _journal_path(lib_path: str) -> str:
+    return lib_path + ".journal"
+
+
+class _RenameJournal:
+    """
+    Append-only log of completed renames, kept next to the rename library.
+
+    Every rename is appended as one JSON line just before it is attempted, and
+    written through to the OS at once, so no rename can outlive its record when
+    the process is killed. Against a crash of the machine the file is only
+    fsynced once per JOURNAL_SYNC_OPS records or JOURNAL_SYNC_INTERVAL seconds,
+    whichever comes first, and on close. Once the library itself has been saved
+    the journal is removed; if a run dies before that, the next run replays the
+    records whose rename did happen.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        sync_ops: int = JOURNAL_SYNC_OPS,
+        sync_interval: float = JOURNAL_SYNC_INTERVAL,
+    ):
+        self.path = path
+        self._sync_ops = sync_ops
+        self._sync_interval = sync_interval
+        self._f = open(path, "a", encoding="utf-8")
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def append(self, flattened: str, original: str) -> None:
+        record = json.dumps([flattened, original], ensure_ascii=False) + "\n"
+        self._f.write(record)
+        self._f.flush()
+        _stats.count("journal.records")
+        self._unsynced += 1
+        if self._unsynced >= self._sync_ops or time.monotonic() - self._last_sync >= self._sync_interval:
+            self.sync()
+
+    def sync(self) -> None:
+        self._f.flush()
+        _stats.count("syscalls.fsync")
+        os.fsync(self._f.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self) -> None:
+        if not self._f.closed:
+            self.sync()
+            self._f.close()
+
+    def remove(self) -> None:
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _replay_journal(path: str, root: str, library) -> int:
+    """
+    Add the records of a leftover journal to library. Returns how many were added.
+
+    Records are written before their rename, so only those whose original is
+    gone from under root and whose flattened name exists are taken, the same
+    test --resume applies. A torn final record from a crash mid-write is cut off
+    the file, so that records appended by the next run start on a line of their own.
+    """
+    count = 0
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return 0
+    with f:
+        offset = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                flattened, original = json.loads(line)
+            except ValueError:
+                break
+            offset += len(line)
+            if os.path.lexists(os.path.join(root, flattened)) and not os.path.lexists(os.path.join(root, original)):
+                library[flattened] = original
+                count += 1
+        torn = f.tell() != offset
+    if torn:
+        os.truncate(path, offset)
+    return count
+
+
+class RenameLibrary:
+    """
+    Mapping of flattened file names to their original paths, as stored in .rename_lib.
+
+    Backends differ in how the mapping is kept on disk; all of them can be looked up
+    by flattened name, updated one entry at a time and iterated as a stream of
+    (flattened, original) pairs.
+    """
+
+    format: str = ""
+    # Leading bytes that identify the format's files; empty for plain JSON.
+    MAGIC = b""
+    # Whether get() is cheap without reading the whole library, so repack can
+    # look up just the files present.
+    random_access = False
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @classmethod
+    def check_available(cls) -> None:
+        """Raise ImportError if the format needs a module this Python does not have."""
+
+    def get(self, flattened: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def get_flattened(self, original: str) -> Optional[str]:
+        """Reverse lookup: the flattened name recorded for an original path."""
+        for flattened, candidate in self.items():
+            if candidate == original:
+                return flattened
+        return None
+
+    def __contains__(self, flattened: str) -> bool:
+        return self.get(flattened) is not None
+
+    def __setitem__(self, flattened: str, original: str) -> None:
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        raise NotImplementedError
+
+    def sorted_items(self) -> Iterator[Tuple[str, str]]:
+        """The entries ordered by flattened name."""
+        return iter(sorted(self.items()))
+
+    def update(self, pairs: Iterable[Tuple[str, str]]) -> None:
+        for flattened, original in pairs:
+            self[flattened] = original
+
+    def save(self) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    @classmethod
+    def write(cls, path: str, pairs: Iterable[Tuple[str, str]]) -> None:
+        """Write pairs as a library of this format at path, replacing whatever is there."""
+        library = cls(path, load=False)
+        library.update(pairs)
+        library.save()
+        library.close()
+
+
+JSON_STREAM_CHUNK = 1 << 16
+
+
+def _iter_json_pairs(f: TextIO, chunk_size: int = JSON_STREAM_CHUNK) -> Iterator[Tuple[str, str]]:
+    """
+    Yield the (key, value) pairs of a JSON object of strings, reading f in chunks.
+
+    Only one chunk plus the pair being decoded is held in memory, which is all a
+    .rename_lib needs; anything other than a flat object of strings is rejected.
+    """
+    from json.decoder import WHITESPACE, scanstring
+
+    buf = ""
+    pos = 0
+    eof = False
+
+    def _fill() -> bool:
+        nonlocal buf, pos, eof
+        if eof:
+            return False
+        chunk = f.read(chunk_size)
+        buf = buf[pos:] + chunk
+        pos = 0
+        eof = not chunk
+        return not eof
+
+    def _next_char() -> str:
+        # Skip whitespace and return the next significant character without consuming it.
+        nonlocal pos
+        while True:
+            pos = WHITESPACE.match(buf, pos).end()
+            if pos < len(buf):
+                return buf[pos]
+            if not _fill():
+                raise ValueError("Unexpected end of rename library")
+
+    def _expect(char: str) -> None:
+        nonlocal pos
+        found = _next_char()
+        if found != char:
+            raise ValueError("Expected %r in rename library, found %r" % (char, found))
+        pos += 1
+
+    def _string() -> str:
+        nonlocal pos
+        _expect('"')
+        while True:
+            try:
+                value, end = scanstring(buf, pos)
+            except json.JSONDecodeError:
+                # The string may continue in the next chunk.
+                if _fill():
+                    continue
+                raise
+            pos = end
+            return value
+
+    _expect("{")
+    if _next_char() == "}":
+        return
+    while True:
+        key = _string()
+        _expect(":")
+        value = _string()
+        yield key, value
+        if _next_char() == ",":
+            pos += 1
+            continue
+        _expect("}")
+        return
+
+
+COMPACT_LIBRARY_BYTES = 256 << 20
+SORT_RUN_ENTRIES = 1 << 18
+
+
+def _sorted_by_runs(pairs: Iterable[Tuple[str, str]], run_entries: int = 0) -> Iterator[Tuple[str, str]]:
+    """
+    Yield pairs sorted, holding at most run_entries (default: SORT_RUN_ENTRIES)
+    of them in memory: once there are more, sorted runs are spilled to
+    temporary files as JSON lines and merged back.
+    """
+    import heapq
+    import tempfile
+    from itertools import islice
+
+    def _read_run(f: TextIO) -> Iterator[Tuple[str, str]]:
+        for line in f:
+            flattened, original = json.loads(line)
+            yield flattened, original
+
+    run_entries = run_entries or SORT_RUN_ENTRIES
+    pairs = iter(pairs)
+    runs: List[TextIO] = []
+    try:
+        while True:
+            run = sorted(islice(pairs, run_entries))
+            if not runs and len(run) < run_entries:
+                yield from run
+                return
+            if not run:
+                break
+            f = tempfile.TemporaryFile("w+", encoding="utf-8")
+            runs.append(f)
+            for pair in run:
+                f.write(json.dumps(pair, ensure_ascii=False) + "\n")
+            f.seek(0)
+            _stats.count("merge.runs_spilled")
+        del run
+        yield from heapq.merge(*(_read_run(f) for f in runs))
+    finally:
+        for f in runs:
+            f.close()
+
+
+class _CompactEntries:
+    """
+    Mapping of flattened names to original paths packed into a few flat buffers.
+
+    An original is split into its parent directory, interned in a table, and its
+    basename, whose UTF-8 bytes go into one shared bytearray. A flattened name
+    almost always ends with that same basename, so it is kept as an interned
+    prefix (e.g. "./a_b_" for the files of ./a/b) plus, only when it does not,
+    its own tail in the bytearray. Lookups probe open-addressing tables of row
+    numbers keyed by str hashes: one for flattened names, and one for originals
+    built on the first reverse lookup. An entry thus costs its basename bytes
+    and a few array slots instead of two str objects and dict slots.
+    """
+
+    __slots__ = (
+        "_blob",
+        "_start",
+        "_base_len",
+        "_tail_len",
+        "_dir",
+        "_prefix",
+        "_hash",
+        "_strings",
+        "_string_ids",
+        "_table",
+        "_reverse",
+        "_reverse_hash",
+        "_reverse_used",
+    )
+
+    # _tail_len of a flattened name that is its prefix plus the original's basename.
+    SAME_TAIL = 0xFFFFFFFF
+
+    def __init__(self) -> None:
+        self._blob = bytearray()
+        self._start = array("Q")
+        self._base_len = array("I")
+        self._tail_len = array("I")
+        self._dir = array("I")
+        self._prefix = array("I")
+        self._hash = array("q")
+        # Directories and flattened prefixes share one interned table.
+        self._strings: List[str] = []
+        self._string_ids: Dict[str, int] = {}
+        # Row number + 1 per slot, 0 for an empty slot; sizes are powers of two.
+        self._table = array("I", bytes(4 * 8))
+        self._reverse: Optional[array] = None
+        self._reverse_hash: Optional[array] = None
+        self._reverse_used = 0
+
+    def __len__(self) -> int:
+        return len(self._start)
+
+    def _intern(self, string: str) -> int:
+        string_id = self._string_ids.get(string)
+        if string_id is None:
+            string_id = self._string_ids[string] = len(self._strings)
+            self._strings.append(string)
+        return string_id
+
+    def _base(self, row: int) -> str:
+        start = self._start[row]
+        return self._blob[start : start + self._base_len[row]].decode("utf-8", "surrogatepass")
+
+    def _flattened(self, row: int) -> str:
+        tail_len = self._tail_len[row]
+        if tail_len == self.SAME_TAIL:
+            return self._strings[self._prefix[row]] + self._base(row)
+        start = self._start[row] + self._base_len[row]
+        return self._strings[self._prefix[row]] + self._blob[start : start + tail_len].decode("utf-8", "surrogatepass")
+
+    def _original(self, row: int) -> str:
+        return self._strings[self._dir[row]] + self._base(row)
+
+    def _slot(self, flattened: str, h: int) -> int:
+        table = self._table
+        mask = len(table) - 1
+        i = h & mask
+        while True:
+            row = table[i]
+            if not row or (self._hash[row - 1] == h and self._flattened(row - 1) == flattened):
+                return i
+            i = (i + 1) & mask
+
+    def _reverse_slot(self, original: str, h: int) -> int:
+        # Overwritten rows leave their old slot behind; it no longer compares
+        # equal and is probed past like a tombstone.
+        table = self._reverse
+        mask = len(table) - 1
+        i = h & mask
+        while True:
+            row = table[i]
+            if not row or (self._reverse_hash[row - 1] == h and self._original(row - 1) == original):
+                return i
+            i = (i + 1) & mask
+
+    def _build(self, hashes: array) -> array:
+        """A table of every row, keyed by hashes, filled to at most a third."""
+        rows = len(self._start)
+        size = 8
+        while size < rows * 3:
+            size *= 2
+        table = array("I", bytes(4 * size))
+        mask = size - 1
+        # Latest rows first, so a probe meets them before older rows that share
+        # an original, as later assignments win in a dict.
+        for row in range(rows - 1, -1, -1):
+            i = hashes[row] & mask
+            while table[i]:
+                i = (i + 1) & mask
+            table[i] = row + 1
+        return table
+
+    def get(self, flattened: str, default: Optional[str] = None) -> Optional[str]:
+        row = self._table[self._slot(flattened, hash(flattened))]
+        return self._original(row - 1) if row else default
+
+    def __contains__(self, flattened: str) -> bool:
+        return bool(self._table[self._slot(flattened, hash(flattened))])
+
+    def get_flattened(self, original: str) -> Optional[str]:
+        if self._reverse is None:
+            self._reverse_hash = array("q", (hash(self._original(row)) for row in range(len(self))))
+            self._reverse = self._build(self._reverse_hash)
+            self._reverse_used = len(self)
+        row = self._reverse[self._reverse_slot(original, hash(original))]
+        return self._flattened(row - 1) if row else None
+
+    def __setitem__(self, flattened: str, original: str) -> None:
+        h = hash(flattened)
+        slot = self._slot(flattened, h)
+        split = max(original.rfind("/"), original.rfind("\\")) + 1
+        base = original[split:]
+        base_bytes = base.encode("utf-8", "surrogatepass")
+        if base and flattened.endswith(base):
+            prefix = flattened[: len(flattened) - len(base)]
+            tail_bytes = b""
+            tail_len = self.SAME_TAIL
+        else:
+            tail_split = max(flattened.rfind("/"), flattened.rfind("\\")) + 1
+            prefix = flattened[:tail_split]
+            tail_bytes = flattened[tail_split:].encode("utf-8", "surrogatepass")
+            tail_len = len(tail_bytes)
+
+        row = self._table[slot] - 1
+        if row < 0:
+            row = len(self._start)
+            self._start.append(len(self._blob))
+            self._base_len.append(len(base_bytes))
+            self._tail_len.append(tail_len)
+            self._dir.append(self._intern(original[:split]))
+            self._prefix.append(self._intern(prefix))
+            self._hash.append(h)
+            self._table[slot] = row + 1
+            if row * 3 >= len(self._table) * 2:
+                self._table = self._build(self._hash)
+            if self._reverse_hash is not None:
+                self._reverse_hash.append(0)
+        else:
+            # The old bytes stay in the blob; overwrites are rare.
+            self._start[row] = len(self._blob)
+            self._base_len[row] = len(base_bytes)
+            self._tail_len[row] = tail_len
+            self._dir[row] = self._intern(original[:split])
+            self._prefix[row] = self._intern(prefix)
+        self._blob += base_bytes
+        self._blob += tail_bytes
+
+        if self._reverse is not None:
+            h = hash(original)
+            self._reverse_hash[row] = h
+            slot = self._reverse_slot(original, h)
+            if not self._reverse[slot]:
+                self._reverse_used += 1
+            self._reverse[slot] = row + 1
+            # Slots left behind by overwrites count too; a rebuild drops them.
+            if self._reverse_used * 3 > len(self._reverse) * 2:
+                self._reverse = self._build(self._reverse_hash)
+                self._reverse_used = len(self._start)
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        for row in range(len(self)):
+            yield self._flattened(row), self._original(row)
+
+
+class JsonLibrary(RenameLibrary):
+    """
+    The original format: one JSON object, loaded and rewritten as a whole.
+
+    With stream=True nothing is loaded up front; items() decodes the file pair by
+    pair, and the full mapping is only materialized if a lookup needs it. The
+    reverse index for get_flattened is built on the first reverse lookup and kept
+    in step with later updates; it shares its strings with the forward mapping.
+
+    With compact=True entries are held in a _CompactEntries instead of a dict,
+    trading slower lookups for a fraction of the memory; by default that happens
+    for files of COMPACT_LIBRARY_BYTES or more, which are then decoded as a
+    stream rather than through json.load. Compressed files are always decoded
+    as a stream, and go compact once their decoded text passes that size.
+
+    Subclasses store the same JSON compressed by overriding _decompress and
+    _compress; reads and writes stream through them either way.
+    """
+
+    format = "json"
+
+    def __init__(self, path: str, load: bool = True, stream: bool = False, compact: Optional[bool] = None):
+        super().__init__(path)
+        self.compact = compact
+        self._entries: Optional[Dict[str, str]] = _CompactEntries() if compact else {}
+        self._originals: Optional[Dict[str, str]] = None
+        if load and stream:
+            self._entries = None
+        elif load:
+            self._load()
+
+    @classmethod
+    def _decompress(cls, raw: BinaryIO) -> BinaryIO:
+        return raw
+
+    @classmethod
+    def _compress(cls, raw: BinaryIO) -> BinaryIO:
+        return raw
+
+    @contextmanager
+    def _reading(self) -> Iterator[Tuple[TextIO, int]]:
+        """
+        The library's JSON text, and its size in bytes; None for a compressed
+        file, whose decoded size is only known once it has been read.
+        """
+        with open(self.path, "rb") as raw:
+            size = os.fstat(raw.fileno()).st_size
+            _stats.count("library.bytes_read", size)
+            stream = self._decompress(raw)
+            try:
+                yield io.TextIOWrapper(stream, encoding="utf-8"), size if stream is raw else None
+            finally:
+                if stream is not raw:
+                    stream.close()
+
+    @classmethod
+    @contextmanager
+    def _writing(cls, path: str) -> Iterator[TextIO]:
+        """JSON text written through the format's compressor to path, synced on exit."""
+        with open(path, "wb") as raw:
+            stream = cls._compress(raw)
+            text = io.TextIOWrapper(stream, encoding="utf-8")
+            yield text
+            text.flush()
+            # Leave raw open for the sync; closing a compressor writes its trailer.
+            text.detach()
+            if stream is not raw:
+                stream.close()
+            raw.flush()
+            os.fsync(raw.fileno())
+            _stats.count("library.bytes_written", os.fstat(raw.fileno()).st_size)
+
+    def _load(self) -> Dict[str, str]:
+        with self._reading() as (f, size):
+            if self.compact is None and size is None:
+                entries = self._load_growing(f)
+            elif self.compact or (self.compact is None and size >= COMPACT_LIBRARY_BYTES):
+                entries = _CompactEntries()
+                for flattened, original in _iter_json_pairs(f):
+                    entries[flattened] = original
+            else:
+                entries = json.load(f)
+        if not isinstance(entries, (dict, _CompactEntries)):
+            raise ValueError("%s is not a rename library" % self.path)
+        self._entries = entries
+        return entries
+
+    @staticmethod
+    def _load_growing(f: TextIO) -> Dict[str, str]:
+        """
+        Decode f into a dict, moving to a _CompactEntries once more than
+        COMPACT_LIBRARY_BYTES of JSON text have been read.
+        """
+        pairs = _iter_json_pairs(f)
+        entries: Dict[str, str] = {}
+        for flattened, original in pairs:
+            entries[flattened] = original
+            # The decoded position is only checked now and then; it runs ahead
+            # of the pairs by at most one read.
+            if not len(entries) & 0xFFF and f.buffer.tell() >= COMPACT_LIBRARY_BYTES:
+                compact = _CompactEntries()
+                for flattened, original in entries.items():
+                    compact[flattened] = original
+                entries.clear()
+                for flattened, original in pairs:
+                    compact[flattened] = original
+                return compact
+        return entries
+
+    def _mapping(self) -> Dict[str, str]:
+        return self._entries if self._entries is not None else self._load()
+
+    def get(self, flattened: str) -> Optional[str]:
+        return self._mapping().get(flattened)
+
+    def get_flattened(self, original: str) -> Optional[str]:
+        entries = self._mapping()
+        if isinstance(entries, _CompactEntries):
+            return entries.get_flattened(original)
+        if self._originals is None:
+            self._originals = {original: flattened for flattened, original in self._mapping().items()}
+        return self._originals.get(original)
+
+    def __contains__(self, flattened: str) -> bool:
+        return flattened in self._mapping()
+
+    def __setitem__(self, flattened: str, original: str) -> None:
+        entries = self._mapping()
+        if self._originals is not None:
+            previous = entries.get(flattened)
+            if previous is not None and self._originals.get(previous) == flattened:
+                del self._originals[previous]
+            self._originals[original] = flattened
+        entries[flattened] = original
+
+    def __len__(self) -> int:
+        return len(self._mapping())
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        if self._entries is not None:
+            return iter(self._entries.items())
+        return self._stream_items()
+
+    def _stream_items(self) -> Iterator[Tuple[str, str]]:
+        with self._reading() as (f, _):
+            yield from _iter_json_pairs(f)
+
+    def sorted_items(self) -> Iterator[Tuple[str, str]]:
+        if self._entries is None:
+            # A file already in key order, such as the output of lib merge, is
+            # streamed again instead of being loaded and sorted.
+            previous = None
+            for flattened, _ in self._stream_items():
+                if previous is not None and flattened <= previous:
+                    break
+                previous = flattened
+            else:
+                return self._stream_items()
+            # Not loaded, and rename writes in walk order: sort without loading it.
+            return _sorted_by_runs(self._stream_items())
+        return iter(sorted(self._mapping().items()))
+
+    @classmethod
+    def write(cls, path: str, pairs: Iterable[Tuple[str, str]]) -> None:
+        """Write pairs in the layout of json.dump, without holding them in memory."""
+        from json.encoder import encode_basestring as encode
+
+        with cls._writing(path) as f:
+            f.write("{")
+            separator = ""
+            for flattened, original in pairs:
+                f.write("%s%s: %s" % (separator, encode(flattened), encode(original)))
+                separator = ", "
+            f.write("}")
+
+    def save(self) -> None:
+        tmp_path = self.path + ".tmp"
+        if isinstance(self._entries, _CompactEntries):
+            self.write(tmp_path, self._entries.items())
+        else:
+            with self._writing(tmp_path) as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+class GzipJsonLibrary(JsonLibrary):
+    """JSON library compressed with gzip."""
+
+    format = "json.gz"
+    MAGIC = b"\x1f\x8b"
+
+    @classmethod
+    def _decompress(cls, raw: BinaryIO) -> BinaryIO:
+        import gzip
+
+        return gzip.GzipFile(fileobj=raw, mode="rb")
+
+    @classmethod
+    def _compress(cls, raw: BinaryIO) -> BinaryIO:
+        import gzip
+
+        # No file name or timestamp in the header: equal libraries give equal files.
+        return gzip.GzipFile(filename="", fileobj=raw, mode="wb", compresslevel=6, mtime=0)
+
+
+class LzmaJsonLibrary(JsonLibrary):
+    """JSON library compressed with xz, usually several times smaller than gzip."""
+
+    format = "json.xz"
+    MAGIC = b"\xfd7zXZ\x00"
+
+    @classmethod
+    def _decompress(cls, raw: BinaryIO) -> BinaryIO:
+        import lzma
+
+        return lzma.LZMAFile(raw, "rb")
+
+    @classmethod
+    def _compress(cls, raw: BinaryIO) -> BinaryIO:
+        import lzma
+
+        # Higher presets are many times slower and gain little on path lists.
+        return lzma.LZMAFile(raw, "wb", preset=1)
+
+
+class ZstdJsonLibrary(JsonLibrary):
+    """
+    JSON library compressed with Zstandard, through compression.zstd (Python
+    3.14+) or the zstandard package, whichever is available.
+    """
+
+    format = "json.zst"
+    MAGIC = b"\x28\xb5\x2f\xfd"
+
+    def __init__(self, path: str, load: bool = True, stream: bool = False, compact: Optional[bool] = None):
+        # Fail before any rename is made rather than when saving.
+        self.check_available()
+        super().__init__(path, load, stream, compact)
+
+    @classmethod
+    def check_available(cls) -> None:
+        cls._zstd()
+
+    @staticmethod
+    def _zstd():
+        try:
+            from compression import zstd
+        except ImportError:
+            try:
+                import zstandard as zstd
+            except ImportError:
+                raise ImportError("json.zst libraries need Python 3.14+ or the zstandard package.") from None
+        return zstd
+
+    @classmethod
+    def _decompress(cls, raw: BinaryIO) -> BinaryIO:
+        zstd = cls._zstd()
+        if hasattr(zstd, "ZstdFile"):
+            return zstd.ZstdFile(raw, "rb")
+        return zstd.ZstdDecompressor().stream_reader(raw, closefd=False)
+
+    @classmethod
+    def _compress(cls, raw: BinaryIO) -> BinaryIO:
+        zstd = cls._zstd()
+        if hasattr(zstd, "ZstdFile"):
+            return zstd.ZstdFile(raw, "wb")
+        return zstd.ZstdCompressor().stream_writer(raw, closefd=False)
+
+
+SQLITE_BATCH = 1000
+
+
+class SqliteLibrary(RenameLibrary):
+    """
+    Library kept in an SQLite database, indexed by flattened name and by original path.
+
+    Entries are written in batched transactions as renames complete and are read back
+    lazily, so memory does not grow with the size of the library.
+    """
+
+    format = "sqlite"
+    MAGIC = b"SQLite format 3\x00"
+
+    def __init__(self, path: str, load: bool = True):
+        import sqlite3
+
+        super().__init__(path)
+        if not load:
+            for stale in (path, path + "-journal"):
+                try:
+                    os.remove(stale)
+                except FileNotFoundError:
+                    pass
+        elif not os.path.exists(path):
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        # Writes are serialized by the rename executor, which may call in from
+        # its worker threads.
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS library (flattened TEXT PRIMARY KEY, original TEXT NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS library_original ON library (original)")
+        self._conn.commit()
+        self._uncommitted = 0
+
+    def get(self, flattened: str) -> Optional[str]:
+        row = self._conn.execute("SELECT original FROM library WHERE flattened = ?", (flattened,)).fetchone()
+        return row[0] if row else None
+
+    def get_flattened(self, original: str) -> Optional[str]:
+        row = self._conn.execute("SELECT flattened FROM library WHERE original = ?", (original,)).fetchone()
+        return row[0] if row else None
+
+    def __setitem__(self, flattened: str, original: str) -> None:
+        self._conn.execute("INSERT OR REPLACE INTO library VALUES (?, ?)", (flattened, original))
+        self._uncommitted += 1
+        if self._uncommitted >= SQLITE_BATCH:
+            self.save()
+
+    def update(self, pairs: Iterable[Tuple[str, str]]) -> None:
+        self._conn.executemany("INSERT OR REPLACE INTO library VALUES (?, ?)", pairs)
+        self.save()
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM library").fetchone()[0]
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        return iter(self._conn.execute("SELECT flattened, original FROM library"))
+
+    def sorted_items(self) -> Iterator[Tuple[str, str]]:
+        return iter(self._conn.execute("SELECT flattened, original FROM library ORDER BY flattened"))
+
+    def save(self) -> None:
+        self._conn.commit()
+        self._uncommitted = 0
+
+    def close(self) -> None:
+        self.save()
+        self._conn.close()
+
+
+BINARY_HEADER = struct.Struct("<8sHHIQQQQQ")
+BINARY_OFFSET = struct.Struct("<Q")
+BINARY_PAIR = struct.Struct("<II")
+
+
+def _little_endian(data: array) -> array:
+    if sys.byteorder != "little":
+        data.byteswap()
+    return data
+
+
+class BinaryLibrary(RenameLibrary):
+    """
+    Library in a binary file that is memory-mapped and queried in place, so
+    opening it costs the same for any size and only the pages a lookup touches
+    are read.
+
+    Layout, little-endian: a header (magic, version, flags, log2 of the slot
+    count, entry count, and the offsets of the sections below), a heap holding
+    each entry's flattened name and original back to back as UTF-8, the record
+    table sorted by flattened name as two columns (heap offsets, then pairs of
+    name and original lengths), and two open-addressing slot tables of
+    (crc32, record + 1) keyed by flattened name and by original. Iteration walks
+    the record table, so it is already in key order.
+
+    Updates are kept in memory on top of the mapped file and folded in by
+    save(), which rewrites the file.
+    """
+
+    format = "binary"
+    MAGIC = b"\x89ULIB\r\n\x1a"
+    VERSION = 1
+    random_access = True
+
+    def __init__(self, path: str, load: bool = True):
+        # crc32 is stable across processes, unlike hash().
+        from zlib import crc32
+
+        super().__init__(path)
+        self._hash = crc32
+        self._map = None
+        self._count = 0
+        self._slot_mask = 0
+        self._records = self._forward = self._reverse = self._heap = 0
+        # Entries set since the file was mapped: flattened -> original, and back.
+        self._pending: Dict[str, str] = {}
+        self._pending_originals: Dict[str, str] = {}
+        self._added = 0
+        if load:
+            self._open()
+
+    def _open(self) -> None:
+        import mmap
+
+        with open(self.path, "rb") as f:
+            header = f.read(BINARY_HEADER.size)
+            if len(header) < BINARY_HEADER.size or not header.startswith(self.MAGIC):
+                raise ValueError("%s is not a binary rename library" % self.path)
+            magic, version, _, slot_bits, count, records, forward, reverse, heap = BINARY_HEADER.unpack(header)
+            if version != self.VERSION:
+                raise ValueError("%s has unsupported binary library version %d" % (self.path, version))
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._count = count
+        self._slot_mask = (1 << slot_bits) - 1
+        self._records, self._forward, self._reverse, self._heap = records, forward, reverse, heap
+
+    def _record(self, index: int) -> Tuple[bytes, bytes]:
+        (offset,) = BINARY_OFFSET.unpack_from(self._map, self._records + 8 * index)
+        flat_len, orig_len = BINARY_PAIR.unpack_from(self._map, self._records + 8 * (self._count + index))
+        start = self._heap + offset
+        return self._map[start : start + flat_len], self._map[start + flat_len : start + flat_len + orig_len]
+
+    def _find(self, table: int, key: bytes, side: int) -> Optional[Tuple[bytes, bytes]]:
+        # side picks the half of a record the key is compared with: 0 for the
+        # flattened name, 1 for the original.
+        if self._map is None:
+            return None
+        h = self._hash(key)
+        i = h & self._slot_mask
+        while True:
+            slot_hash, record = BINARY_PAIR.unpack_from(self._map, table + 8 * i)
+            if not record:
+                return None
+            if slot_hash == h:
+                pair = self._record(record - 1)
+                if pair[side] == key:
+                    return pair
+            i = (i + 1) & self._slot_mask
+
+    def _stored(self, flattened: str) -> Optional[str]:
+        found = self._find(self._forward, flattened.encode("utf-8", "surrogatepass"), 0)
+        return found[1].decode("utf-8", "surrogatepass") if found else None
+
+    def get(self, flattened: str) -> Optional[str]:
+        original = self._pending.get(flattened)
+        return original if original is not None else self._stored(flattened)
+
+    def get_flattened(self, original: str) -> Optional[str]:
+        flattened = self._pending_originals.get(original)
+        if flattened is not None and self._pending.get(flattened) == original:
+            return flattened
+        found = self._find(self._reverse, original.encode("utf-8", "surrogatepass"), 1)
+        if found is None:
+            return None
+        flattened = found[0].decode("utf-8", "surrogatepass")
+        # The file's mapping may have been replaced since.
+        return flattened if self._pending.get(flattened, original) == original else None
+
+    def __setitem__(self, flattened: str, original: str) -> None:
+        if flattened not in self._pending and self._stored(flattened) is None:
+            self._added += 1
+        self._pending[flattened] = original
+        self._pending_originals[original] = flattened
+
+    def __len__(self) -> int:
+        return self._count + self._added
+
+    def _stored_items(self) -> Iterator[Tuple[str, str]]:
+        for index in range(self._count):
+            flattened, original = self._record(index)
+            yield flattened.decode("utf-8", "surrogatepass"), original.decode("utf-8", "surrogatepass")
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        return self.sorted_items()
+
+    def sorted_items(self) -> Iterator[Tuple[str, str]]:
+        if not self._pending:
+            return self._stored_items()
+        return self._merged_items()
+
+    def _merged_items(self) -> Iterator[Tuple[str, str]]:
+        import heapq
+
+        pending = sorted(self._pending.items())
+        previous = None
+        # Pending entries come first among equal names and win.
+        for flattened, original in heapq.merge(pending, self._stored_items(), key=lambda pair: pair[0]):
+            if flattened != previous:
+                yield flattened, original
+            previous = flattened
+
+    @classmethod
+    def write(cls, path: str, pairs: Iterable[Tuple[str, str]]) -> None:
+        """Write pairs, sorted by flattened name and unique, as a binary library at path."""
+        from zlib import crc32
+
+        offsets = array("Q")
+        lengths = array("I")
+        hashes = array("I")
+        with open(path, "wb") as f:
+            f.write(bytes(BINARY_HEADER.size))
+            heap = f.tell()
+            offset = 0
+            for flattened, original in pairs:
+                flat_bytes = flattened.encode("utf-8", "surrogatepass")
+                orig_bytes = original.encode("utf-8", "surrogatepass")
+                f.write(flat_bytes)
+                f.write(orig_bytes)
+                offsets.append(offset)
+                lengths.append(len(flat_bytes))
+                lengths.append(len(orig_bytes))
+                hashes.append(crc32(flat_bytes))
+                hashes.append(crc32(orig_bytes))
+                offset += len(flat_bytes) + len(orig_bytes)
+            count = len(offsets)
+
+            # Align the tables to 8 bytes.
+            f.write(bytes(-f.tell() % 8))
+            records = f.tell()
+            _little_endian(offsets).tofile(f)
+            _little_endian(lengths).tofile(f)
+            del offsets, lengths
+
+            # Slot tables at most half full, so probes stay short.
+            slot_bits = 3
+            while (1 << slot_bits) < count * 2:
+                slot_bits += 1
+            mask = (1 << slot_bits) - 1
+            tables = []
+            for side in (0, 1):
+                tables.append(f.tell())
+                slots = array("I", bytes(8 << slot_bits))
+                for index in range(count):
+                    h = hashes[2 * index + side]
+                    i = h & mask
+                    while slots[2 * i + 1]:
+                        i = (i + 1) & mask
+                    slots[2 * i] = h
+                    slots[2 * i + 1] = index + 1
+                _little_endian(slots).tofile(f)
+                del slots
+
+            f.seek(0)
+            f.write(
+                BINARY_HEADER.pack(cls.MAGIC, cls.VERSION, 0, slot_bits, count, records, tables[0], tables[1], heap)
+            )
+            f.flush()
+            os.fsync(f.fileno())
+            _stats.count("library.bytes_written", os.fstat(f.fileno()).st_size)
+
+    def save(self) -> None:
+        if not self._pending and self._map is not None:
+            return
+        tmp_path = self.path + ".tmp"
+        self.write(tmp_path, self.sorted_items())
+        self.close()
+        os.replace(tmp_path, self.path)
+        self._pending = {}
+        self._pending_originals = {}
+        self._added = 0
+        self._open()
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._count = 0
+
+
+LIBRARY_FORMATS = {
+    JsonLibrary.format: JsonLibrary,
+    GzipJsonLibrary.format: GzipJsonLibrary,
+    LzmaJsonLibrary.format: LzmaJsonLibrary,
+    ZstdJsonLibrary.format: ZstdJsonLibrary,
+    SqliteLibrary.format: SqliteLibrary,
+    BinaryLibrary.format: BinaryLibrary,
+}
+
+
+def detect_library_format(path: str) -> Optional[str]:
+    """Guess the format of an existing library file from its leading bytes."""
+    try:
+        with open(path, "rb") as f:
+            magic = f.read(16)
+    except FileNotFoundError:
+        return None
+    for cls in LIBRARY_FORMATS.values():
+        if cls.MAGIC and magic.startswith(cls.MAGIC):
+            return cls.format
+    return JsonLibrary.format
+
+
+def open_library(path: str, fmt: Optional[str] = None, stream: bool = False) -> RenameLibrary:
+    """
+    Open an existing library, converting it when fmt names a different format.
+
+    stream=True asks for a library that is only going to be iterated; JSON files
+    are then decoded incrementally instead of being loaded whole. Raises
+    FileNotFoundError when there is no library at path.
+    """
+    detected = detect_library_format(path)
+    if detected is None:
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+    converting = fmt is not None and fmt != detected
+    cls = LIBRARY_FORMATS[detected]
+    if issubclass(cls, JsonLibrary):
+        library: RenameLibrary = cls(path, stream=stream or converting)
+    else:
+        library = cls(path)
+    if not converting:
+        return library
+    try:
+        converted = LIBRARY_FORMATS[fmt](path + ".convert", load=False)
+        converted.update(library.items())
+        converted.save()
+    finally:
+        library.close()
+    converted.close()
+    os.replace(path + ".convert", path)
+    return LIBRARY_FORMATS[fmt](path)
+
+
+def new_library(path: str, fmt: str = JsonLibrary.format) -> RenameLibrary:
+    """Start an empty library that will replace whatever is at path when saved."""
+    return LIBRARY_FORMATS[fmt](path, load=False)
+
+
+MERGE_CONFLICT_POLICIES = ("fail", "first", "last")
+
+
+def _merge_sorted(
+    streams: List[Iterator[Tuple[str, str]]], names: List[str], on_conflict: str, counts: Dict[str, int]
+) -> Iterator[Tuple[str, str]]:
+    """
+    k-way merge of libraries sorted by flattened name into one sorted stream of
+    unique entries. A flattened name mapped to different originals is logged and
+    counted as a conflict; on_conflict picks which input's mapping is kept.
+    """
+    import heapq
+
+    def _tag(i: int, stream: Iterator[Tuple[str, str]]) -> Iterator[Tuple[str, int, str]]:
+        # Ties on the flattened name then come out in input order.
+        for flattened, original in stream:
+            yield flattened, i, original
+
+    tagged = [_tag(i, stream) for i, stream in enumerate(streams)]
+    group: List[Tuple[str, int, str]] = []
+    for entry in heapq.merge(*tagged):
+        if group and entry[0] != group[0][0]:
+            yield _resolve_group(group, names, on_conflict, counts)
+            group = []
+        group.append(entry)
+    if group:
+        yield _resolve_group(group, names, on_conflict, counts)
+
+
+def _resolve_group(
+    group: List[Tuple[str, int, str]], names: List[str], on_conflict: str, counts: Dict[str, int]
+) -> Tuple[str, str]:
+    flattened = group[0][0]
+    if len({original for _, _, original in group}) > 1:
+        counts["conflicts"] += 1
+        _stats.count("merge_conflicts")
+        logger.warning(
+            "Conflicting entries for %s: %s."
+            % (flattened, ", ".join("%s in %s" % (original, names[i]) for _, i, original in group))
+        )
+    counts["entries"] += 1
+    _, _, original = group[-1] if on_conflict == "last" else group[0]
+    return flattened, original
+
+
+def merge_libraries(
+    inputs: List[str], output: str, fmt: Optional[str] = None, on_conflict: str = "fail"
+) -> Tuple[int, int]:
+    """
+    Merge several rename libraries of any format into one written to output,
+    sorted by flattened name and without duplicates. Inputs are read as sorted
+    streams and merged k ways, so no input is loaded whole: JSON libraries not
+    already in key order are sorted in runs spilled to temporary files (see
+    _sorted_by_runs). fmt defaults to the format of the first input; output may
+    be one of the inputs.
+
+    A flattened name mapped to different originals is a conflict: with
+    on_conflict "fail" every conflict is logged and ValueError is raised without
+    writing output, "first" and "last" keep the mapping from the earliest or
+    latest input listing it. Returns (entries written, conflicts).
+    """
+    if on_conflict not in MERGE_CONFLICT_POLICIES:
+        raise ValueError("Unknown conflict policy %r." % on_conflict)
+    libraries: List[RenameLibrary] = []
+    try:
+        for path in inputs:
+            libraries.append(open_library(path, stream=True))
+            if os.path.exists(_journal_path(path)):
+                logger.warning(
+                    "%s has a pending journal; its entries are not merged. Run rename --resume on its root first."
+                    % path
+                )
+        fmt = fmt or libraries[0].format
+        counts = {"entries": 0, "conflicts": 0}
+        tmp_path = output + ".merge"
+        with _stats.phase("merge"):
+            pairs = _merge_sorted([library.sorted_items() for library in libraries], inputs, on_conflict, counts)
+            LIBRARY_FORMATS[fmt].write(tmp_path, pairs)
+    finally:
+        for library in libraries:
+            library.close()
+    if counts["conflicts"] and on_conflict == "fail":
+        os.remove(tmp_path)
+        raise ValueError(
+            "%d conflicting entries; nothing written. Use --on-conflict first or last to merge anyway."
+            % counts["conflicts"]
+        )
+    os.replace(tmp_path, output)
+    return counts["entries"], counts["conflicts"]
+
+
+class RenamePlan:
+    """
+    Planned filesystem operations of a rename run, in walk order. Paths are
+    relative to the root, in the "./a/b.jpg" form recorded in the library.
+    """
+
+    __slots__ = ("renames", "rmdirs", "skipped")
+
+    def __init__(self) -> None:
+        self.renames: List[Tuple[str, str]] = []
+        # Post-order, so each directory comes after everything below it.
+        self.rmdirs: List[str] = []
+        # (path, reason) of files left in place: "exists" when the flattened name
+        # is taken, "renamed" when the library records the file under another name.
+        self.skipped: List[Tuple[str, str]] = []
+
+
+def _checkpoint_path(lib_path: str, command: str) -> str:
+    return "%s.%s-plan" % (lib_path, command)
+
+
+class _PlanCheckpoint:
+    """
+    On-disk copy of a plan, written while it is built, so --resume can pick it up.
+
+    One JSON record per line: a header with the parameters the plan depends on,
+    ["r", src, dst] per rename, ["d", path] per directory to remove, ["c", path]
+    once the subtree under a top-level directory has been fully planned, and ["e"]
+    when planning finished. On load, everything after the last "c" or "e" record
+    is discarded.
+    """
+
+    def __init__(self, path: str, params: Dict[str, object], resume: bool = False):
+        self.path = path
+        self.renames: List[Tuple[str, str]] = []
+        self.rmdirs: List[str] = []
+        self.subtrees: set = set()
+        self.complete = False
+        self.resumed = resume and self._load(params)
+        if self.resumed:
+            self._f = open(path, "a", encoding="utf-8")
+        else:
+            self._f = open(path, "w", encoding="utf-8")
+            self._write(["h", params])
+
+    def _load(self, params: Dict[str, object]) -> bool:
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return False
+        with f:
+            header = f.readline()
+            try:
+                if json.loads(header) != ["h", params]:
+                    return False
+            except ValueError:
+                return False
+            # Operations of a subtree that was still being planned are dropped,
+            # along with their records, and planned again.
+            offset = committed = len(header)
+            renames: List[Tuple[str, str]] = []
+            rmdirs: List[str] = []
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                offset += len(line)
+                kind = record[0]
+                if kind == "r":
+                    renames.append((record[1], record[2]))
+                elif kind == "d":
+                    rmdirs.append(record[1])
+                elif kind in ("c", "e"):
+                    if kind == "c":
+                        self.subtrees.add(record[1])
+                    else:
+                        self.complete = True
+                    self.renames.extend(renames)
+                    self.rmdirs.extend(rmdirs)
+                    renames.clear()
+                    rmdirs.clear()
+                    committed = offset
+        os.truncate(self.path, committed)
+        return True
+
+    def _write(self, record: list) -> None:
+        self._f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def rename(self, src: str, dst: str) -> None:
+        self._write(["r", src, dst])
+
+    def rmdir(self, path: str) -> None:
+        self._write(["d", path])
+
+    def subtree_done(self, path: str) -> None:
+        self._write(["c", path])
+        self._f.flush()
+
+    def finish(self) -> None:
+        self._write(["e"])
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self.complete = True
+
+    def to_plan(self) -> RenamePlan:
+        plan = RenamePlan()
+        plan.renames = self.renames
+        plan.rmdirs = self.rmdirs
+        return plan
+
+    def close(self) -> None:
+        if not self._f.closed:
+            self._f.close()
+
+    def remove(self) -> None:
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _recover_checkpoint(path: str, root: str, library: RenameLibrary) -> int:
+    """
+    Add the renames of a leftover rename checkpoint for root that did happen,
+    i.e. whose src is gone and whose dst exists, to library. A run without
+    --resume starts a new checkpoint, and this keeps it from dropping those
+    moves. Returns how many were added.
+    """
+    count = 0
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return 0
+    with f:
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            return 0
+        if header[0] != "h" or header[1].get("root") != root:
+            return 0
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if record[0] != "r":
+                continue
+            src, dst = record[1], record[2]
+            if library.get(dst) == src:
+                continue
+            if os.path.lexists(os.path.join(root, dst)) and not os.path.lexists(os.path.join(root, src)):
+                library[dst] = src
+                count += 1
+    return count
+
+
+class _WalkFrame:
+    __slots__ = ("entries", "path", "fd", "head", "floor", "rmdir_path", "empty")
+
+    def __init__(self, entries, path, fd, head, floor, rmdir_path):
+        self.entries: Iterator[os.DirEntry] = entries
+        self.path: str = path
+        self.fd: Optional[int] = fd
+        self.head: int = head
+        self.floor: int = floor
+        self.rmdir_path: Optional[str] = rmdir_path
+        self.empty: bool = True
+
+
+def _plan_rename(
     dir_path: str,
     head: int,
     floor: int,
-    library: Dict[str, str],
+    library: RenameLibrary,
     collapse_self_dir: bool,
-) -> None:
-    entries = os.scandir(dir_path)
-    for entry in entries:
-        if entry.is_file():
-            relative_path = entry.path[head:]
-            new_name = entry.path[:head] + relative_path.replace("\\", "_").replace("/", "_")
-            if collapse_self_dir:
-                normalized_rel = relative_path.replace("\\", "/")
-                if normalized_rel.count("/") == 1:
-                    parent_candidate, file_part = normalized_rel.split("/", 1)
-                    file_stem, file_ext = os.path.splitext(file_part)
-                    if file_stem == parent_candidate:
-                        new_name = entry.path[:head] + file_stem + file_ext
-            if new_name != entry.path:
-                if not os.path.exists(new_name):
-                    if entry.path in library:
-                        logger.info("File %s has been renamed. Skipped." % (entry.path))
+    scanner: Optional[_PrefetchScanner] = None,
+    checkpoint: Optional[_PlanCheckpoint] = None,
+    root: str = "",
+    taken: Optional[set] = None,
+    remove_top: bool = False,
+) -> RenamePlan:
+    # Depth-first walk driven by an explicit stack instead of recursion, so deep
+    # trees are not bounded by the interpreter recursion limit. Each frame keeps
+    # the listing of one directory together with the head/floor state of that
+    # level, the directory to remove once the frame is exhausted, and whether the
+    # directory is expected to be empty by then. Serial walks also keep each
+    # directory open along the current path, down to _DIR_FD_DEPTH levels, and
+    # list children relative to it.
+    #
+    # Renamed files only ever land in the directory at depth `floor`, so the
+    # names listed there plus every planned destination are all that a collision
+    # check has to consult; no per-file stat is needed. A subdirectory that is
+    # going to be removed frees its name again, as it did when renames and rmdir
+    # were interleaved.
+    #
+    # With a checkpoint, every planned operation is also recorded on disk and each
+    # finished top-level subtree is marked, so a resumed run can take over the
+    # operations planned so far and skip those subtrees without listing them again.
+    #
+    # Paths are relative to root; only the filesystem calls resolve them against it.
+    #
+    # A shard plans a single top-level subtree: dir_path is then that subtree,
+    # taken arrives pre-filled with the root listing, and remove_top says whether
+    # the subtree directory itself goes once emptied.
+    use_fds = scanner is None and _DIR_FD_SUPPORTED
+    plan = RenamePlan()
+    taken = set() if taken is None else taken
+    stack: List[_WalkFrame] = []
+    planned_subtrees: set = set()
+    removed: set = set()
+    if checkpoint is not None and checkpoint.resumed:
+        plan = checkpoint.to_plan()
+        taken.update(os.path.normcase(dst) for _, dst in plan.renames)
+        planned_subtrees = checkpoint.subtrees
+        removed = {os.path.normcase(path) for path in plan.rmdirs}
+
+    def _push(path: str, name: str, parent_fd: Optional[int], head: int, floor: int, rmdir_path: Optional[str]) -> None:
+        fd = None
+        if use_fds and len(stack) < _DIR_FD_DEPTH:
+            fd = _open_dir(name if parent_fd is not None else os.path.join(root, path), dir_fd=parent_fd)
+            try:
+                entries = _list_dir(fd)
+            except BaseException:
+                os.close(fd)
+                raise
+        elif scanner is not None:
+            entries = scanner.scan(path)
+        else:
+            entries = _list_dir(os.path.join(root, path))
+        _stats.count("dirs_visited")
+        if floor == 0:
+            taken.update(os.path.normcase(_entry_path(path, entry)) for entry in entries)
+        stack.append(_WalkFrame(iter(entries), path, fd, head, floor, rmdir_path))
+
+    try:
+        _push(dir_path, dir_path, None, head, floor, dir_path if remove_top else None)
+        while stack:
+            frame = stack[-1]
+            entry = next(frame.entries, None)
+            if entry is None:
+                stack.pop()
+                if frame.fd is not None:
+                    os.close(frame.fd)
+                if frame.rmdir_path is not None and frame.empty:
+                    plan.rmdirs.append(frame.rmdir_path)
+                    taken.discard(os.path.normcase(frame.rmdir_path))
+                    if checkpoint is not None:
+                        checkpoint.rmdir(frame.rmdir_path)
+                elif stack:
+                    stack[-1].empty = False
+                if checkpoint is not None and len(stack) == 1:
+                    checkpoint.subtree_done(frame.path)
+                continue
+
+            path = _entry_path(frame.path, entry)
+            if entry.is_file():
+                _stats.count("files_scanned")
+                new_name = _flatten_name(path, frame.head, collapse_self_dir)
+                if new_name != path:
+                    new_key = os.path.normcase(new_name)
+                    if new_key not in taken:
+                        # An original recorded under another flattened name was
+                        # renamed before; one recorded under this very name is
+                        # simply flattened again, e.g. after repack --keep-lib.
+                        recorded = library.get_flattened(path)
+                        if recorded is not None and recorded != new_name:
+                            plan.skipped.append((path, "renamed"))
+                            _stats.count("renames_skipped")
+                            _log_file("Skipped, already renamed", "File %s has been renamed. Skipped.", path)
+                        else:
+                            plan.renames.append((path, new_name))
+                            taken.add(new_key)
+                            if checkpoint is not None:
+                                checkpoint.rename(path, new_name)
+                            continue
+                    else:
+                        plan.skipped.append((path, "exists"))
+                        _stats.count("collisions")
+                        _log_file("Skipped, name exists", "File %s has existed. Skipped.", new_name)
+                frame.empty = False
+            else:
+                if entry.is_symlink():
+                    frame.empty = False
+                if len(stack) == 1 and path in planned_subtrees:
+                    if os.path.normcase(path) in removed:
+                        taken.discard(os.path.normcase(path))
                     else:
-                        logger.info("Rename %s to %s." % (entry.path, new_name))
-                        os.rename(entry.path, new_name)
-                        library[new_name] = entry.path
+                        frame.empty = False
+                    continue
+                _push(
+                    path,
+                    entry.name,
+                    frame.fd,
+                    frame.head + (len(entry.name) + 1 if frame.floor > 0 else 0),
+                    frame.floor - 1,
+                    path if frame.floor <= 0 else None,
+                )
+    finally:
+        for frame in stack:
+            if frame.fd is not None:
+                os.close(frame.fd)
+    if checkpoint is not None:
+        checkpoint.finish()
+    return plan
+
+
+def _entry_path(dir_path: str, entry: os.DirEntry) -> str:
+    # Built from the name rather than entry.path: entries listed from a descriptor
+    # only carry their name, and listings resolved against a root carry the root.
+    # "<dir_path><sep><name>" matches the original backslash concatenation on Windows.
+    return dir_path + os.sep + entry.name
+
+
+def _execute_renames(
+    ops: Iterable[Tuple[str, str]],
+    rename_one: Callable[[str, str], bool],
+    on_done: Optional[Callable[[str, str], None]] = None,
+    workers: int = 1,
+) -> None:
+    """
+    Run rename_one(src, dst) for every operation, on `workers` threads.
+
+    Operations are sharded by destination, so all operations touching the same
+    destination run on one worker in their original order. on_done(src, dst) is
+    called after each rename_one that returns True, serialized under a lock. The
+    first exception stops the remaining work and is re-raised.
+    """
+    if isinstance(ops, list):
+        _stats.expect(len(ops))
+    if workers <= 1:
+        try:
+            for src, dst in ops:
+                renamed = rename_one(src, dst)
+                _stats.count("renames_attempted")
+                if renamed and on_done is not None:
+                    on_done(src, dst)
+        finally:
+            _close_dir_fds()
+        return
+
+    shards: List[List[Tuple[str, str]]] = [[] for _ in range(workers)]
+    for src, dst in ops:
+        shards[hash(os.path.normcase(dst)) % workers].append((src, dst))
+
+    done_lock = threading.Lock()
+    failed = threading.Event()
+
+    def _run_shard(shard: List[Tuple[str, str]]) -> None:
+        try:
+            for src, dst in shard:
+                if failed.is_set():
+                    return
+                try:
+                    renamed = rename_one(src, dst)
+                except BaseException:
+                    failed.set()
+                    raise
+                _stats.count("renames_attempted")
+                if renamed and on_done is not None:
+                    with done_lock:
+                        on_done(src, dst)
+        finally:
+            _close_dir_fds()
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rename") as pool:
+        futures = [pool.submit(_run_shard, shard) for shard in shards if shard]
+    for future in futures:
+        future.result()
+
+
+class RenameResult:
+    """
+    Outcome of a rename run on one root. Paths are relative to the root, as in
+    RenamePlan; for a dry run, renamed and removed_dirs hold what was planned.
+    """
+
+    __slots__ = ("root", "renamed", "skipped", "removed_dirs", "dry_run")
+
+    def __init__(self, root: str, dry_run: bool = False) -> None:
+        self.root = root
+        self.renamed: List[Tuple[str, str]] = []
+        self.skipped: List[Tuple[str, str]] = []
+        self.removed_dirs: List[str] = []
+        self.dry_run = dry_run
+
+
+class Planner:
+    """
+    Plans how rename flattens the tree under root, without touching it.
+
+    All paths are resolved against root, never against the working directory,
+    so planners for different roots may run concurrently on separate threads.
+    """
+
+    def __init__(self, root: str, floor: int = 0, collapse_self_dir: bool = True, scan_workers: int = 0):
+        self.root = os.path.abspath(root)
+        self.floor = floor
+        self.collapse_self_dir = collapse_self_dir
+        self.scan_workers = scan_workers
+
+    def checkpoint_params(self) -> Dict[str, object]:
+        return {"root": self.root, "floor": self.floor, "collapse_self_dir": self.collapse_self_dir}
+
+    def plan(self, library: RenameLibrary, checkpoint: Optional[_PlanCheckpoint] = None) -> RenamePlan:
+        if checkpoint is not None and checkpoint.resumed and checkpoint.complete:
+            logger.info("Resume from a complete rename plan.")
+            return checkpoint.to_plan()
+        scanner = _PrefetchScanner(self.scan_workers, self.root) if self.scan_workers > 0 else None
+        try:
+            with _stats.phase("plan"):
+                # Walking "." keeps the original "./a/b.jpg" paths, hence head 2.
+                return _plan_rename(
+                    ".", 2, self.floor, library, self.collapse_self_dir, scanner, checkpoint, root=self.root
+                )
+        finally:
+            if scanner is not None:
+                scanner.close()
+
+
+class Executor:
+    """
+    Applies a RenamePlan under root on `workers` threads, recording every
+    completed rename in the library (and journal, when given).
+    """
+
+    def __init__(self, root: str, workers: int = 1):
+        self.root = os.path.abspath(root)
+        self.workers = workers
+
+    def apply(
+        self,
+        plan: RenamePlan,
+        library: RenameLibrary,
+        journal: Optional[_RenameJournal] = None,
+        resume: bool = False,
+    ) -> RenameResult:
+        root = self.root
+        result = RenameResult(root)
+        result.skipped.extend(plan.skipped)
+        lock = threading.Lock()
+
+        def _rename_one(src: str, dst: str) -> bool:
+            start = time.perf_counter()
+            dst_path = os.path.join(root, dst)
+            if journal is not None:
+                # Ahead of the rename: a run killed in between leaves a record
+                # that replay checks against the tree, rather than a lost move.
+                with lock:
+                    journal.append(dst, src)
+            src_path = os.path.join(root, src)
+            try:
+                _rename_noreplace(src_path, dst_path)
+            except FileExistsError:
+                # With src moved by the interrupted run as well, the error may
+                # be either one: renameat2 does not promise which check comes
+                # first, and the stat fallback looks at dst first.
+                if resume and not os.path.lexists(src_path):
+                    _log_file("Skipped, already renamed", "File %s has been renamed. Skipped.", src)
+                    return True
+                _stats.count("collisions")
+                _log_file("Skipped, name exists", "File %s has existed. Skipped.", dst)
+                with lock:
+                    result.skipped.append((src, "exists"))
+                return False
+            except FileNotFoundError:
+                # Moved by the interrupted run after its last journal sync.
+                if resume and os.path.lexists(dst_path):
+                    _log_file("Skipped, already renamed", "File %s has been renamed. Skipped.", src)
+                    return True
+                raise
+            _stats.observe("rename_seconds", time.perf_counter() - start)
+            _stats.count("renames_done")
+            _log_file("Renamed", "Rename %s to %s.", src, dst)
+            return True
+
+        def _record(src: str, dst: str) -> None:
+            library[dst] = src
+            result.renamed.append((src, dst))
+
+        renames: List[Tuple[str, str]] = plan.renames
+        if resume:
+            # Renames the interrupted run completed are already in the library.
+            renames = [(src, dst) for src, dst in plan.renames if library.get(dst) != src]
+        # The planner lets a file take the name of a directory it removes, so
+        # such a rename has to wait until that directory is gone.
+        deferred: Dict[str, List[Tuple[str, str]]] = {}
+        if plan.rmdirs:
+            removed = {os.path.normcase(path) for path in plan.rmdirs}
+            now: List[Tuple[str, str]] = []
+            for src, dst in renames:
+                key = os.path.normcase(dst)
+                if key in removed:
+                    deferred.setdefault(key, []).append((src, dst))
                 else:
-                    logger.info("File %s has existed. Skipped." % new_name)
-        else:
-            # Preserve original recursion and path concatenation with backslash
-            subdir = dir_path + "\\" + entry.name
-            _rename_walk(
-                subdir,
-                head + (len(entry.name) + 1 if floor > 0 else 0),
-                floor - 1,
-                library,
-                collapse_self_dir,
-            )
-            if floor <= 0:
+                    now.append((src, dst))
+            renames = now
+        with _stats.phase("rename"):
+            _execute_renames(renames, _rename_one, _record, self.workers)
+        # Directories go last and in order: every rename below them has finished.
+        # Renames into a removed directory's name were planned after its removal
+        # and before the removal of their own parent, so they run right after it.
+        with _stats.phase("rmdir"):
+            try:
+                for path in plan.rmdirs:
+                    try:
+                        dir_fd, name = _split_dir_fd(os.path.join(root, path))
+                        _stats.count("syscalls.rmdir")
+                        os.rmdir(name, dir_fd=dir_fd)
+                    except Exception:
+                        pass
+                    else:
+                        result.removed_dirs.append(path)
+                    for src, dst in deferred.pop(os.path.normcase(path), ()):
+                        renamed = _rename_one(src, dst)
+                        _stats.count("renames_attempted")
+                        if renamed:
+                            _record(src, dst)
+            finally:
+                _close_dir_fds()
+        return result
+
+
+def rename(
+    root: str,
+    lib_path: Optional[str] = None,
+    floor: int = 0,
+    collapse_self_dir: bool = True,
+    scan_workers: int = 0,
+    dry_run: bool = False,
+    workers: int = 1,
+    lib_format: Optional[str] = None,
+    resume: bool = False,
+    processes: int = 1,
+) -> RenameResult:
+    """
+    Flatten the tree under root and record the mapping in the rename library
+    (default: <root>/.rename_lib). The working directory is left alone, so calls
+    on different roots, each with its own library, may run on separate threads.
+
+    With processes > 1, top-level subtrees are renamed by a pool of worker
+    processes when they cannot compete for flattened names (see _can_shard);
+    otherwise, and for dry runs and resumed runs, the root is renamed here.
+    """
+    planner = Planner(root, floor, collapse_self_dir, scan_workers)
+    root_abs = planner.root
+    lib_abs = os.path.abspath(lib_path if lib_path else os.path.join(root_abs, ".rename_lib"))
+
+    with _stats.phase("library_load"):
+        try:
+            library = open_library(lib_abs, None if dry_run else lib_format)
+            logger.info("Found rename library.")
+        except ImportError:
+            # The library exists but cannot be read here; starting a new one
+            # would overwrite it.
+            raise
+        except Exception:
+            logger.info("Create a new rename library.")
+            if dry_run:
+                library = JsonLibrary(lib_abs, load=False)
+            else:
+                library = new_library(lib_abs, lib_format or JsonLibrary.format)
+
+        journal_path = _journal_path(lib_abs)
+        recovered = 0
+        if not dry_run:
+            recovered = _replay_journal(journal_path, root_abs, library)
+            recovered += _recover_shards(lib_abs, root_abs, library)
+            if not resume:
+                recovered += _recover_checkpoint(_checkpoint_path(lib_abs, "rename"), root_abs, library)
+        elif (
+            os.path.exists(journal_path)
+            or os.path.exists(_checkpoint_path(lib_abs, "rename"))
+            or _shard_parts(lib_abs)
+        ):
+            # Recovery writes to the library (and trims the journal); a dry run
+            # leaves both to the next real run.
+            logger.info("Found records of an interrupted run. They are recovered by the next run.")
+    if recovered:
+        logger.info("Recovered %d entries from rename journal." % recovered)
+
+    if dry_run:
+        try:
+            plan = planner.plan(library)
+        finally:
+            library.close()
+        for src, dst in plan.renames:
+            _log_file("Would rename", "Would rename %s to %s.", src, dst)
+        result = RenameResult(root_abs, dry_run=True)
+        result.renamed = plan.renames
+        result.skipped = plan.skipped
+        result.removed_dirs = plan.rmdirs
+        return result
+
+    if processes > 1 and not resume:
+        result = _rename_sharded(planner, library, lib_abs, processes, workers)
+        if result is not None:
+            with _stats.phase("library_save"):
+                library.save()
+                library.close()
+            _remove_shards(lib_abs)
+            for path in (journal_path, _checkpoint_path(lib_abs, "rename")):
                 try:
-                    os.rmdir(entry.path)
-                except Exception:
+                    os.remove(path)
+                except FileNotFoundError:
                     pass
+            return result
+        logger.info("Top-level directories may collide once flattened. Rename in a single process.")
+
+    journal = _RenameJournal(journal_path)
+    checkpoint = _PlanCheckpoint(_checkpoint_path(lib_abs, "rename"), planner.checkpoint_params(), resume)
+    if resume and not checkpoint.resumed:
+        logger.info("No matching rename checkpoint. Start from scratch.")
+    try:
+        plan = planner.plan(library, checkpoint)
+        result = Executor(root_abs, workers).apply(plan, library, journal, checkpoint.resumed)
+    finally:
+        journal.close()
+        checkpoint.close()
+
+    # Compact the journal into the library; only then is it safe to drop it.
+    with _stats.phase("library_save"):
+        library.save()
+        library.close()
+    journal.remove()
+    checkpoint.remove()
+    _remove_shards(lib_abs)
+    return result
+
+
+def _shards_path(lib_path: str) -> str:
+    return lib_path + ".shards"
+
+
+def _can_shard(top_names: List[str], floor: int, collapse_self_dir: bool) -> bool:
+    """
+    Whether top-level subtrees can be renamed independently of one another.
+
+    With floor >= 1 every file stays inside its top-level directory. With floor 0
+    everything from T lands in the root as "T_..." (or "T.<ext>" when collapsing),
+    so two subtrees can only compete for a name when one top-level name is the
+    other followed by such a separator.
+    """
+    if floor >= 1:
+        return True
+    separators = ("_", ".") if collapse_self_dir else ("_",)
+    names = sorted(os.path.normcase(name) for name in top_names)
+    # Names sharing a prefix are adjacent once sorted.
+    for i, name in enumerate(names):
+        for other in names[i + 1 :]:
+            if not other.startswith(name):
+                break
+            if len(other) > len(name) and other[len(name)] in separators:
+                return False
+    return True
+
+
+def _merge_shard(
+    library: RenameLibrary, part_path: str, root: str, renamed: Optional[List[Tuple[str, str]]] = None
+) -> int:
+    """
+    Merge a shard's partial library, and whatever its journal holds, into
+    library. A flattened name mapped differently in library is reported and
+    takes the shard's mapping: the rename only succeeded because nothing
+    occupied that name. Returns the number of entries merged.
+    """
+    try:
+        part: RenameLibrary = JsonLibrary(part_path)
+    except FileNotFoundError:
+        part = JsonLibrary(part_path, load=False)
+    _replay_journal(_journal_path(part_path), root, part)
+    merged = 0
+    for flattened, original in part.items():
+        existing = library.get(flattened)
+        if existing is not None and existing != original:
+            _stats.count("merge_conflicts")
+            logger.warning("Library entry %s -> %s replaces %s -> %s." % (flattened, original, flattened, existing))
+        library[flattened] = original
+        if renamed is not None:
+            renamed.append((original, flattened))
+        merged += 1
+    part.close()
+    return merged
+
+
+def _shard_parts(lib_path: str) -> List[str]:
+    try:
+        with open(_shards_path(lib_path), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def _recover_shards(lib_path: str, root: str, library: RenameLibrary) -> int:
+    """Merge the partial libraries left behind by an interrupted sharded run of root."""
+    return sum(_merge_shard(library, part, root) for part in _shard_parts(lib_path))
 
-def cmd_rename(root: str, floor: int, lib_path: str, collapse_self_dir: bool) -> None:
-    root_abs = os.path.abspath(root)
-    lib_abs = os.path.abspath(lib_path)
 
+def _remove_shards(lib_path: str) -> None:
+    for part in _shard_parts(lib_path):
+        for path in (part, _journal_path(part)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
     try:
-        with open(lib_abs, "r", encoding="utf-8") as f:
-            library = json.load(f)
-        logger.info("Found rename library.")
-    except Exception:
-        logger.info("Create a new rename library.")
-        library = dict()
-
-    old_cwd = os.getcwd()
+        os.remove(_shards_path(lib_path))
+    except FileNotFoundError:
+        pass
+
+
+def _shard_rename(task: Dict[str, object], options: Dict[str, object]) -> Dict[str, object]:
+    """Plan and rename one top-level subtree in a worker process, into a partial library."""
+    setup_logging(options["log_mode"])
+    if options["collect_stats"]:
+        _stats.enable()
+    floor = options["floor"]
+    # The library entries whose originals lie in this subtree, for the planner's
+    # "already renamed" check.
+    known = JsonLibrary(task["part"], load=False)
+    known.update(task["known"])
     try:
-        os.chdir(root_abs)
-        head = 2
-        _rename_walk(".", head, floor, library, collapse_self_dir)
+        with _stats.phase("plan"):
+            plan = _plan_rename(
+                task["top"],
+                2 if floor <= 0 else 2 + len(task["name"]) + 1,
+                floor - 1,
+                known,
+                options["collapse_self_dir"],
+                root=task["root"],
+                taken=task["taken"],
+                remove_top=floor <= 0,
+            )
+        part = new_library(task["part"])
+        journal = _RenameJournal(_journal_path(task["part"]))
+        try:
+            result = Executor(task["root"], options["workers"]).apply(plan, part, journal)
+        finally:
+            journal.close()
+        part.save()
+        part.close()
+        journal.remove()
     finally:
-        os.chdir(old_cwd)
+        log_counts = _take_log_counts()
+        shutdown_logging()
+    return {
+        "skipped": result.skipped,
+        "removed_dirs": result.removed_dirs,
+        "log_counts": log_counts,
+        "stats": _stats.snapshot() if options["collect_stats"] else None,
+    }
+
+
+def _rename_sharded(
+    planner: Planner, library: RenameLibrary, lib_abs: str, processes: int, workers: int
+) -> Optional[RenameResult]:
+    """
+    Rename each top-level subtree of the planner's root in its own worker
+    process and merge the partial libraries into library. Returns None, having
+    done nothing, when the subtrees could compete for flattened names.
+    """
+    root_abs = planner.root
+    entries = _list_dir(root_abs)
+    tops = [entry.name for entry in entries if not entry.is_file()]
+    if not _can_shard(tops, planner.floor, planner.collapse_self_dir):
+        return None
+
+    # What each shard needs from the whole: the root listing, which a floor 0
+    # collision check consults, and the library entries with originals inside its subtree.
+    taken = None
+    if planner.floor == 0:
+        taken = {os.path.normcase(_entry_path(".", entry)) for entry in entries}
+    known: Dict[str, List[Tuple[str, str]]] = {name: [] for name in tops}
+    for flattened, original in library.items():
+        parts = original.split(os.sep, 2)
+        if len(parts) == 3 and parts[0] == "." and parts[1] in known:
+            known[parts[1]].append((flattened, original))
+
+    # Files from a subtree only ever land on "./<top>_...", "./<top>.<ext>" or
+    # "./<top>" itself, so that is all of the listing its shard is sent.
+    taken_sorted = sorted(taken) if taken is not None else []
+
+    def _taken_by(name: str) -> Optional[set]:
+        if taken is None:
+            return None
+        top = os.path.normcase("." + os.sep + name)
+        found = {top} & taken
+        for prefix in (top + "_", top + "."):
+            i = bisect.bisect_left(taken_sorted, prefix)
+            while i < len(taken_sorted) and taken_sorted[i].startswith(prefix):
+                found.add(taken_sorted[i])
+                i += 1
+        return found
+
+    part_paths = ["%s.part-%d" % (lib_abs, i) for i in range(len(tops))]
+    with open(_shards_path(lib_abs), "w", encoding="utf-8") as f:
+        json.dump(part_paths, f)
+    tasks = [
+        {
+            "root": root_abs,
+            "name": name,
+            "top": "." + os.sep + name,
+            "known": known.pop(name),
+            "taken": _taken_by(name),
+            "part": part_path,
+        }
+        for name, part_path in zip(tops, part_paths)
+    ]
+    options = {
+        "floor": planner.floor,
+        "collapse_self_dir": planner.collapse_self_dir,
+        "workers": workers,
+        "log_mode": _log_mode,
+        "collect_stats": _stats.enabled,
+    }
 
-    with open(lib_abs, "w", encoding="utf-8") as f:
-        json.dump(library, f, ensure_ascii=False)
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+
+    result = RenameResult(root_abs)
+    error: Optional[BaseException] = None
+    with _stats.phase("shards"):
+        _stats.expect(len(tasks))
+        # Spawned rather than forked: the parent may be running metrics and progress threads.
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [pool.submit(_shard_rename, task, options) for task in tasks]
+            for future in futures:
+                try:
+                    report = future.result()
+                except BaseException as exc:
+                    # Keep collecting: every shard's work has to reach the library.
+                    error = error or exc
+                    continue
+                result.skipped.extend(report["skipped"])
+                result.removed_dirs.extend(report["removed_dirs"])
+                _add_log_counts(report["log_counts"])
+                if report["stats"] is not None:
+                    _stats.merge(report["stats"])
+                _stats.count("shards_done")
+    with _stats.phase("merge"):
+        for part_path in part_paths:
+            _merge_shard(library, part_path, root_abs, result.renamed)
+    if error is not None:
+        raise error
+    return result
+
+
+def cmd_rename(
+    root: str,
+    floor: int,
+    lib_path: str,
+    collapse_self_dir: bool,
+    scan_workers: int = 0,
+    dry_run: bool = False,
+    workers: int = 1,
+    lib_format: Optional[str] = None,
+    resume: bool = False,
+    processes: int = 1,
+) -> RenameResult:
+    return rename(
+        root, lib_path, floor, collapse_self_dir, scan_workers, dry_run, workers, lib_format, resume, processes
+    )
 
 
-def cmd_repack(root: str, lib_path: str, keep_lib: bool) -> None:
+class RepackResult:
+    """
+    Outcome of a repack run on one root: restored holds (flattened, original) as
+    absolute paths, skipped holds (path, reason) of files left in place.
+    """
+
+    __slots__ = ("root", "restored", "skipped")
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.restored: List[Tuple[str, str]] = []
+        self.skipped: List[Tuple[str, str]] = []
+
+
+def repack(
+    root: str,
+    lib_path: Optional[str] = None,
+    keep_lib: bool = False,
+    workers: int = 1,
+    resume: bool = False,
+) -> RepackResult:
+    """
+    Restore the files flattened under root, using the rename library (default:
+    <root>/.rename_lib) or the classic underscore method without one. Paths are
+    resolved against root, so calls on different roots may run on separate threads.
+    """
     root_abs = os.path.abspath(root)
-    lib_abs = os.path.abspath(lib_path)
+    lib_abs = os.path.abspath(lib_path if lib_path else os.path.join(root_abs, ".rename_lib"))
+    result = RepackResult(root_abs)
+    lock = threading.Lock()
 
     def _normalize_relative(path_str: str) -> Optional[str]:
         if path_str is None:
@@ -136,36 +2847,100 @@ def cmd_repack(root: str, lib_path: str, keep_lib: bool) -> None:
             return None
         return abs_candidate
 
-    library: Optional[Dict[str, str]] = None
-    try:
-        with open(lib_abs, "r", encoding="utf-8") as f:
-            raw_library = json.load(f)
-        normalized_library: Dict[str, str] = {}
-        for flattened, original in raw_library.items():
-            key_rel = _normalize_relative(flattened)
-            value_rel = _normalize_relative(original)
-            if key_rel is None or value_rel is None:
-                logger.info(f"Library entry {flattened} -> {original} is outside root scope. Skip.")
-                continue
-            normalized_library[key_rel] = value_rel
-        library = normalized_library
-        logger.info("Found rename library.")
-    except Exception:
-        library = None
-        logger.info("Library not found. Fallback to classic methods.")
-
-    with os.scandir(root_abs) as entries:
-        for entry in entries:
-            if not entry.is_file():
-                continue
+    journal_path = _journal_path(lib_abs)
+    checkpoint_path = _checkpoint_path(lib_abs, "repack")
+    # The library and the companion files named after it (journal, checkpoints,
+    # shard parts, temporary copies, SQLite's own journal) may live in the root;
+    # they are not flattened images.
+    own_name = os.path.normcase(lib_abs)
+    own_prefixes = (own_name + ".", own_name + "-")
+
+    def _is_own_file(path: str) -> bool:
+        path = os.path.normcase(path)
+        return path == own_name or path.startswith(own_prefixes)
 
-            entry_rel = _normalize_relative(entry.path)
+    def _build_plan() -> List[Tuple[str, str]]:
+        root_files: List[Tuple[os.DirEntry, Optional[str]]] = []
+        _stats.count("syscalls.scandir")
+        with os.scandir(root_abs) as entries:
+            for entry in entries:
+                _stats.count("files_scanned")
+                if entry.is_file() and not _is_own_file(entry.path):
+                    root_files.append((entry, _normalize_relative(entry.path)))
+
+        try:
+            library: Optional[RenameLibrary] = open_library(lib_abs, stream=True)
+        except ImportError:
+            # Falling back to the classic method would misplace files.
+            raise
+        except Exception:
+            library = None
+        # Renames recorded by a run that died before saving the library, in its
+        # journal or, for a sharded run, in the partial libraries of its shards.
+        recovered: Dict[str, str] = {}
+        _replay_journal(journal_path, root_abs, recovered)
+        _recover_shards(lib_abs, root_abs, recovered)
+        if recovered:
+            logger.info("Recovered %d entries from rename journal." % len(recovered))
+
+        def _present_pairs(library: RenameLibrary) -> Iterator[Tuple[str, str]]:
+            # Entries are recorded as "./<name>"; other spellings of the key,
+            # e.g. absolute paths, are only found by reading the whole library.
+            for _, entry_rel in root_files:
+                if not entry_rel:
+                    continue
+                for key in dict.fromkeys(("." + os.sep + entry_rel, "./" + entry_rel)):
+                    original = library.get(key)
+                    if original is not None:
+                        yield key, original
+                        break
+
+        # Stream the library and keep only the entries for files actually present,
+        # rather than materializing a normalized copy of the whole mapping. A
+        # library with random access is only asked about those files.
+        targets: Optional[Dict[str, str]] = None
+        if library is not None or recovered:
+            wanted = {entry_rel for _, entry_rel in root_files if entry_rel}
+            if library is None:
+                stored: Iterable[Tuple[str, str]] = ()
+            elif library.random_access:
+                stored = _present_pairs(library)
+            else:
+                stored = library.items()
+            try:
+                targets = {}
+                for pairs in (stored, recovered.items()):
+                    for flattened, original in pairs:
+                        key_rel = _normalize_relative(flattened)
+                        value_rel = _normalize_relative(original)
+                        if key_rel is None or value_rel is None:
+                            _log_file(
+                                "Skipped, library entry outside root",
+                                "Library entry %s -> %s is outside root scope. Skip.",
+                                flattened,
+                                original,
+                            )
+                            continue
+                        if key_rel in wanted:
+                            targets[key_rel] = value_rel
+                logger.info("Found rename library.")
+            except Exception:
+                targets = None
+            finally:
+                if library is not None:
+                    library.close()
+        if targets is None:
+            logger.info("Library not found. Fallback to classic methods.")
+
+        plan: List[Tuple[str, str]] = []
+        for entry, entry_rel in root_files:
             if entry_rel is None or entry_rel == "":
-                logger.info(f"Unable to normalize path for {entry.path}. Skip.")
+                _log_file("Skipped, path not normalizable", "Unable to normalize path for %s. Skip.", entry.path)
+                result.skipped.append((entry.path, "unnormalizable"))
                 continue
 
             target_rel: Optional[str]
-            if library is None:
+            if targets is None:
                 flattened_name = entry_rel
                 if "_" not in flattened_name and "-U" not in flattened_name:
                     continue
@@ -177,36 +2952,302 @@ def cmd_repack(root: str, lib_path: str, keep_lib: bool) -> None:
                 candidate = candidate.replace("_", "/").replace("-U", "_")
                 target_rel = _normalize_relative(candidate)
             else:
-                target_rel = library.get(entry_rel)
+                target_rel = targets.get(entry_rel)
                 if target_rel is None:
-                    logger.info(f"{entry.path} not in library file. Skip.")
+                    _log_file("Skipped, not in library", "%s not in library file. Skip.", entry.path)
+                    result.skipped.append((entry.path, "not in library"))
                     continue
 
             if not target_rel:
-                logger.info(f"Target path for {entry.path} is empty. Skip.")
+                _log_file("Skipped, empty target", "Target path for %s is empty. Skip.", entry.path)
+                result.skipped.append((entry.path, "empty target"))
                 continue
 
             target_abs = _rel_to_abs(target_rel)
             if target_abs is None:
-                logger.info(f"Target path {target_rel} escapes root {root_abs}. Skip.")
+                _log_file(
+                    "Skipped, target outside root", "Target path %s escapes root %s. Skip.", target_rel, root_abs
+                )
+                result.skipped.append((entry.path, "outside root"))
                 continue
 
-            logger.info("Rename %s to %s" % (entry.path, target_abs))
+            plan.append((entry.path, target_abs))
+        return plan
+
+    checkpoint = _PlanCheckpoint(checkpoint_path, {"root": root_abs}, resume)
+    try:
+        if checkpoint.resumed and checkpoint.complete:
+            # The library and the root listing were already consumed by the
+            # interrupted run; its plan is all that is needed.
+            logger.info("Resume from a complete repack plan.")
+            plan = checkpoint.renames
+        else:
+            if resume:
+                logger.info("No complete repack checkpoint. Start from scratch.")
+            with _stats.phase("plan"):
+                plan = _build_plan()
+            for src, target_abs in plan:
+                checkpoint.rename(src, target_abs)
+            checkpoint.finish()
+    finally:
+        checkpoint.close()
+
+    # Directories known to exist; a set add is atomic, so workers may share it.
+    known_dirs = set()
+
+    def _rename_one(src: str, target_abs: str) -> bool:
+        _log_file("Restoring", "Rename %s to %s", src, target_abs)
 
-            target_dir = os.path.dirname(target_abs)
-            if target_dir and not os.path.exists(target_dir):
+        target_dir = os.path.dirname(target_abs)
+        if target_dir and target_dir not in known_dirs:
+            if not os.path.exists(target_dir):
+                _stats.count("syscalls.mkdir")
                 os.makedirs(target_dir, exist_ok=True)
+            known_dirs.add(target_dir)
 
-            if not os.path.exists(target_abs):
-                os.rename(entry.path, target_abs)
-            else:
-                logger.info("File %s has existed. Skip." % target_abs)
+        start = time.perf_counter()
+        try:
+            _rename_noreplace(src, target_abs)
+        except FileExistsError:
+            # As in Executor: a file the interrupted run restored may fail
+            # either way.
+            if resume and not os.path.lexists(src):
+                _log_file("Skipped, already restored", "File %s has been restored. Skip.", src)
+                return True
+            _stats.count("collisions")
+            _log_file("Skipped, name exists", "File %s has existed. Skip.", target_abs)
+            with lock:
+                result.skipped.append((src, "exists"))
+            return False
+        except FileNotFoundError:
+            # Restored by the interrupted run.
+            if resume and os.path.lexists(target_abs):
+                _log_file("Skipped, already restored", "File %s has been restored. Skip.", src)
+                return True
+            raise
+        _stats.observe("rename_seconds", time.perf_counter() - start)
+        _stats.count("renames_done")
+        return True
+
+    # A flattened file may hold the name of a directory it was moved out of
+    # (rename lets it take the name once the directory is removed), so files
+    # named like a top-level target directory are restored first.
+    target_tops = {
+        os.path.normcase(os.path.relpath(target_abs, root_abs).split(os.sep, 1)[0]) for _, target_abs in plan
+    }
+    first = [(src, dst) for src, dst in plan if os.path.normcase(os.path.basename(src)) in target_tops]
+    if first:
+        blocking = set(first)
+        plan = [op for op in plan if op not in blocking]
+    with _stats.phase("rename"):
+        for ops in (first, plan):
+            _execute_renames(ops, _rename_one, lambda src, dst: result.restored.append((src, dst)), workers)
+    checkpoint.remove()
 
     if not keep_lib:
-        try:
-            os.remove(lib_abs)
-        except Exception:
-            pass
+        for path in (lib_abs, journal_path):
+            try:
+                os.remove(path)
+            except Exception:
+                pass
+        _remove_shards(lib_abs)
+    return result
+
+
+def cmd_repack(
+    root: str,
+    lib_path: str,
+    keep_lib: bool,
+    workers: int = 1,
+    resume: bool = False,
+) -> RepackResult:
+    return repack(root, lib_path, keep_lib, workers, resume)
+
+
+def _check_roots(roots: List[str]) -> Optional[str]:
+    """Return why the roots cannot be processed side by side, or None if they can."""
+    seen: List[str] = []
+    for root in roots:
+        root_abs = os.path.normcase(os.path.abspath(root))
+        for other in seen:
+            try:
+                common = os.path.commonpath([root_abs, other])
+            except ValueError:
+                continue
+            if common in (root_abs, other):
+                return "Roots %s and %s overlap." % (other, root_abs)
+        seen.append(root_abs)
+    return None
+
+
+def _run_roots(roots: List[str], run_one: Callable[[str], object], workers: int) -> int:
+    """
+    Run run_one(root) for every root, on up to `workers` threads. A failing root
+    is logged and does not stop the others. Returns the number of failed roots.
+    """
+    if len(roots) == 1:
+        run_one(roots[0])
+        return 0
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="root") as pool:
+        futures = [(root, pool.submit(run_one, root)) for root in roots]
+        for root, future in futures:
+            try:
+                result = future.result()
+            except Exception as exc:
+                failed += 1
+                logger.error("Failed on %s: %s" % (root, exc))
+                continue
+            if isinstance(result, RenameResult):
+                logger.info(
+                    "Finished %s: %d renamed, %d skipped." % (root, len(result.renamed), len(result.skipped))
+                )
+            elif isinstance(result, RepackResult):
+                logger.info(
+                    "Finished %s: %d restored, %d skipped." % (root, len(result.restored), len(result.skipped))
+                )
+    return failed
+
+
+def _read_manifest(path: str) -> List[Dict[str, object]]:
+    """
+    Read a batch manifest: one root per line, or one JSON object per line with
+    "dir" and optional "floor", "lib" and "collapse_self_dir". Blank lines and
+    lines starting with "#" are ignored. Relative paths are relative to the
+    manifest's directory.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    tasks: List[Dict[str, object]] = []
+    with open(path, "r", encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                try:
+                    task = json.loads(line)
+                except ValueError as exc:
+                    raise ValueError("%s:%d: %s" % (path, lineno, exc))
+                if not isinstance(task.get("dir"), str):
+                    raise ValueError('%s:%d: missing "dir".' % (path, lineno))
+                unknown = set(task) - {"dir", "floor", "lib", "collapse_self_dir"}
+                if unknown:
+                    raise ValueError("%s:%d: unknown keys %s." % (path, lineno, ", ".join(sorted(unknown))))
+            else:
+                task = {"dir": line}
+            task["dir"] = os.path.join(base, task["dir"])
+            if task.get("lib"):
+                task["lib"] = os.path.join(base, task["lib"])
+            tasks.append(task)
+    return tasks
+
+
+def _batch_run_root(task: Dict[str, object], options: Dict[str, object]) -> Dict[str, object]:
+    """Process one manifest entry in a batch worker process and report counts only."""
+    setup_logging(options["log_mode"])
+    if options["collect_stats"]:
+        _stats.enable()
+    root = task["dir"]
+    lib_path = task.get("lib") or os.path.join(root, ".rename_lib")
+    report: Dict[str, object] = {"dir": root, "lib": lib_path, "status": "ok"}
+    start = time.perf_counter()
+    try:
+        if options["command"] == "rename":
+            result = rename(
+                root,
+                lib_path,
+                task.get("floor", options["floor"]),
+                task.get("collapse_self_dir", options["collapse_self_dir"]),
+                options["scan_workers"],
+                options["dry_run"],
+                options["workers"],
+                options["lib_format"],
+                options["resume"],
+            )
+            report.update(
+                renamed=len(result.renamed), skipped=len(result.skipped), removed_dirs=len(result.removed_dirs)
+            )
+        else:
+            result = repack(root, lib_path, options["keep_lib"], options["workers"], options["resume"])
+            report.update(restored=len(result.restored), skipped=len(result.skipped))
+    except Exception as exc:
+        report.update(status="failed", error="%s: %s" % (type(exc).__name__, exc))
+    finally:
+        # Summary counts are totalled by the parent, not printed per root.
+        log_counts = _take_log_counts()
+        shutdown_logging()
+    report["log_counts"] = log_counts
+    report["seconds"] = time.perf_counter() - start
+    if options["collect_stats"]:
+        report["stats"] = _stats.snapshot()
+    return report
+
+
+def cmd_batch(
+    manifest: str,
+    command: str = "rename",
+    jobs: int = 0,
+    report_path: Optional[str] = None,
+    log_mode: str = "per-file",
+    **options,
+) -> int:
+    """
+    Run rename or repack on every root listed in the manifest, on a pool of
+    `jobs` worker processes (default: CPU count). Returns the number of failed
+    roots. Worker statistics are merged into this process's run statistics.
+    """
+    tasks = _read_manifest(manifest)
+    reason = _check_roots([task["dir"] for task in tasks])
+    if reason is not None:
+        raise ValueError(reason)
+    libs = {os.path.normcase(os.path.abspath(task.get("lib") or os.path.join(task["dir"], ".rename_lib"))) for task in tasks}
+    if len(libs) != len(tasks):
+        raise ValueError("Several manifest entries share one rename library.")
+
+    worker_options = dict(options, command=command, log_mode=log_mode, collect_stats=_stats.enabled)
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+
+    start = time.perf_counter()
+    reports: List[Dict[str, object]] = []
+    # Spawned rather than forked: the parent may be running metrics and progress threads.
+    with ProcessPoolExecutor(
+        max_workers=jobs if jobs > 0 else None, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        futures = [pool.submit(_batch_run_root, task, worker_options) for task in tasks]
+        for future in futures:
+            report = future.result()
+            _add_log_counts(report.pop("log_counts"))
+            stats = report.pop("stats", None)
+            if stats is not None:
+                _stats.merge(stats)
+            if report["status"] == "ok":
+                done = "renamed" if command == "rename" else "restored"
+                logger.info(
+                    "Finished %s: %d %s, %d skipped." % (report["dir"], report[done], done, report["skipped"])
+                )
+            else:
+                logger.error("Failed on %s: %s" % (report["dir"], report["error"]))
+            reports.append(report)
+
+    totals: Dict[str, object] = {"roots": len(reports), "failed": 0}
+    for report in reports:
+        if report["status"] != "ok":
+            totals["failed"] += 1
+        for key in ("renamed", "restored", "skipped", "removed_dirs"):
+            if key in report:
+                totals[key] = totals.get(key, 0) + report[key]
+    totals["seconds"] = time.perf_counter() - start
+    logger.info(
+        "Batch finished: %d roots, %d failed, in %.1fs." % (totals["roots"], totals["failed"], totals["seconds"])
+    )
+    if report_path:
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump({"command": command, "totals": totals, "roots": reports}, f, indent=2, ensure_ascii=False)
+    return totals["failed"]
 
 
 def build_parser() -> argparse.ArgumentParser:
@@ -215,14 +3256,46 @@ def build_parser() -> argparse.ArgumentParser:
     )
     sub = p.add_subparsers(dest="command", required=True)
 
+    # Reporting options shared by every subcommand.
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        "--stats",
+        default=None,
+        metavar="PATH",
+        help="Report per-phase timings and counters at the end: to stderr with '-', or as JSON to PATH.",
+    )
+    common.add_argument(
+        "--metrics-file",
+        default=None,
+        metavar="PATH",
+        help="Write run metrics in Prometheus text format to PATH, every %d seconds and at the end "
+        "(e.g. for the node_exporter textfile collector)." % METRICS_INTERVAL,
+    )
+    common.add_argument(
+        "--log-mode",
+        choices=LOG_MODES,
+        default="per-file",
+        help="How to log per-file lines: per-file writes each as it happens, batched buffers them "
+        "in a background writer, summary prints only counts at the end, off drops them. Default: per-file",
+    )
+    common.add_argument(
+        "--progress",
+        action="store_true",
+        help="Show a status line with throughput and ETA on stderr, when stderr is a terminal. "
+        "Best combined with --log-mode summary or off.",
+    )
+
     pr = sub.add_parser(
         "rename",
+        parents=[common],
         help="Flatten file paths into underscores; records mapping in .rename_lib.",
     )
     pr.add_argument(
         "--dir",
-        default=".",
-        help="Root directory to process. Default: current directory (.)",
+        nargs="+",
+        default=["."],
+        help="Root directories to process; several roots are processed concurrently. "
+        "Default: current directory (.)",
     )
     pr.add_argument(
         "--floor",
@@ -235,6 +3308,13 @@ def build_parser() -> argparse.ArgumentParser:
         default=None,
         help="Path to rename library file. Default: <dir>/.rename_lib",
     )
+    pr.add_argument(
+        "--lib-format",
+        choices=sorted(LIBRARY_FORMATS),
+        default=None,
+        help="Storage format of the rename library; an existing library is converted. "
+        "Default: keep the existing format, json for a new library.",
+    )
     pr.add_argument(
         "--no-collapse-self-dir",
         dest="collapse_self_dir",
@@ -242,15 +3322,54 @@ def build_parser() -> argparse.ArgumentParser:
         default=True,
         help="Disable collapsing <name>/<name>.<ext> into <name>.<ext>; default behavior keeps it collapsed.",
     )
+    pr.add_argument(
+        "--scan-workers",
+        type=int,
+        default=0,
+        help="Number of threads listing directories ahead of the walk. Default: 0 (list serially)",
+    )
+    pr.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only print the planned renames; do not touch files or the rename library.",
+    )
+    pr.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of threads issuing renames. Default: 1",
+    )
+    pr.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run from its checkpoint, skipping work it already finished.",
+    )
+    pr.add_argument(
+        "--root-workers",
+        type=int,
+        default=4,
+        help="Number of roots processed at the same time when --dir lists several. Default: 4",
+    )
+    pr.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="Rename top-level subtrees of a root in this many worker processes and merge their "
+        "libraries, when the subtrees cannot collide once flattened (always with --floor 1 or more). "
+        "Default: 1",
+    )
 
     pp = sub.add_parser(
         "repack",
+        parents=[common],
         help="Restore file paths using .rename_lib or classic underscore-based method.",
     )
     pp.add_argument(
         "--dir",
-        default=".",
-        help="Root directory to process. Default: current directory (.)",
+        nargs="+",
+        default=["."],
+        help="Root directories to process; several roots are processed concurrently. "
+        "Default: current directory (.)",
     )
     pp.add_argument(
         "--lib",
@@ -262,29 +3381,194 @@ def build_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="Keep the rename library after repack (original repack.py removed it). Default: remove.",
     )
+    pp.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run from its checkpoint, skipping work it already finished.",
+    )
+    pp.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of threads issuing renames. Default: 1",
+    )
+    pp.add_argument(
+        "--root-workers",
+        type=int,
+        default=4,
+        help="Number of roots processed at the same time when --dir lists several. Default: 4",
+    )
+
+    pb = sub.add_parser(
+        "batch",
+        parents=[common],
+        help="Run rename or repack on every root listed in a manifest, on a pool of processes.",
+    )
+    pb.add_argument(
+        "manifest",
+        help='Manifest file: one root per line, or JSON lines like {"dir": "a", "floor": 1, "lib": "a.lib"}.',
+    )
+    pb.add_argument(
+        "--command",
+        dest="command_name",
+        choices=("rename", "repack"),
+        default="rename",
+        help="What to run on each root. Default: rename",
+    )
+    pb.add_argument(
+        "--jobs",
+        type=int,
+        default=0,
+        help="Number of worker processes. Default: number of CPUs",
+    )
+    pb.add_argument(
+        "--report",
+        default=None,
+        metavar="PATH",
+        help="Write a JSON report with the outcome of every root and the totals to PATH.",
+    )
+    pb.add_argument("--floor", type=int, default=0, help="Default --floor for roots that set none. Default: 0")
+    pb.add_argument(
+        "--lib-format",
+        choices=sorted(LIBRARY_FORMATS),
+        default=None,
+        help="Storage format of new rename libraries; existing ones are converted. Default: json",
+    )
+    pb.add_argument(
+        "--no-collapse-self-dir",
+        dest="collapse_self_dir",
+        action="store_false",
+        default=True,
+        help="Default for roots that do not set collapse_self_dir: do not collapse <name>/<name>.<ext>.",
+    )
+    pb.add_argument("--scan-workers", type=int, default=0, help="--scan-workers of each rename. Default: 0")
+    pb.add_argument("--workers", type=int, default=1, help="Threads issuing renames within each root. Default: 1")
+    pb.add_argument("--dry-run", action="store_true", help="Only print the planned renames.")
+    pb.add_argument("--resume", action="store_true", help="Resume each root from its checkpoint.")
+    pb.add_argument("--keep-lib", action="store_true", help="With --command repack, keep the rename libraries.")
+
+    pl = sub.add_parser("lib", help="Maintain rename library files.")
+    lib_sub = pl.add_subparsers(dest="lib_command", required=True)
+    pm = lib_sub.add_parser(
+        "merge",
+        parents=[common],
+        help="Merge rename libraries from separate runs, hosts or shards into one.",
+    )
+    pm.add_argument("inputs", nargs="+", metavar="LIB", help="Libraries to merge, of any supported format.")
+    pm.add_argument("-o", "--output", required=True, help="Merged library to write; may be one of the inputs.")
+    pm.add_argument(
+        "--format",
+        dest="lib_format",
+        choices=sorted(LIBRARY_FORMATS),
+        default=None,
+        help="Storage format of the merged library. Default: format of the first input",
+    )
+    pm.add_argument(
+        "--on-conflict",
+        choices=MERGE_CONFLICT_POLICIES,
+        default="fail",
+        help="When inputs map one flattened name to different originals: fail writes nothing, "
+        "first or last keeps the mapping from the earliest or latest input listing it. Default: fail",
+    )
 
     return p
 
 
 def main(argv=None):
-    setup_logging()
     parser = build_parser()
     args = parser.parse_args(argv)
+    setup_logging(args.log_mode)
+    show_progress = args.progress and sys.stderr.isatty()
+    if args.stats is not None or args.metrics_file is not None or show_progress:
+        _stats.enable()
+    metrics = _MetricsWriter(args.metrics_file, args.command) if args.metrics_file is not None else None
+    progress = _ProgressReporter(sys.stderr) if show_progress else None
+    try:
+        _run_command(parser, args)
+    finally:
+        if progress is not None:
+            progress.close()
+        shutdown_logging()
+        if metrics is not None:
+            metrics.close()
+        if args.stats is not None:
+            _stats.report(args.stats)
 
-    if args.command == "rename":
-        lib_path = args.lib if args.lib else os.path.join(args.dir, ".rename_lib")
-        cmd_rename(
-            root=args.dir,
-            floor=args.floor,
-            lib_path=lib_path,
-            collapse_self_dir=args.collapse_self_dir,
+
+def _run_command(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    if getattr(args, "lib_format", None) is not None:
+        try:
+            LIBRARY_FORMATS[args.lib_format].check_available()
+        except ImportError as exc:
+            parser.error(str(exc))
+    if args.command == "batch":
+        try:
+            failed = cmd_batch(
+                args.manifest,
+                command=args.command_name,
+                jobs=args.jobs,
+                report_path=args.report,
+                log_mode=args.log_mode,
+                floor=args.floor,
+                collapse_self_dir=args.collapse_self_dir,
+                scan_workers=args.scan_workers,
+                dry_run=args.dry_run,
+                workers=args.workers,
+                lib_format=args.lib_format,
+                resume=args.resume,
+                keep_lib=args.keep_lib,
+            )
+        except (OSError, ValueError) as exc:
+            parser.error(str(exc))
+        if failed:
+            sys.exit(1)
+        return
+    if args.command == "lib":
+        try:
+            entries, conflicts = merge_libraries(args.inputs, args.output, args.lib_format, args.on_conflict)
+        except (OSError, ValueError) as exc:
+            parser.error(str(exc))
+        logger.info(
+            "Merged %d libraries into %s: %d entries, %d conflicts."
+            % (len(args.inputs), args.output, entries, conflicts)
         )
-    elif args.command == "repack":
-        lib_path = args.lib if args.lib else os.path.join(args.dir, ".rename_lib")
-        cmd_repack(root=args.dir, lib_path=lib_path, keep_lib=args.keep_lib)
-    else:
+        return
+    if args.command not in ("rename", "repack"):
         parser.print_help()
         sys.exit(2)
+    if len(args.dir) > 1:
+        if args.lib:
+            parser.error("--lib can only be used with a single --dir; each root keeps its own library.")
+        reason = _check_roots(args.dir)
+        if reason is not None:
+            parser.error(reason)
+
+    def _rename_root(root: str) -> RenameResult:
+        return cmd_rename(
+            root=root,
+            floor=args.floor,
+            lib_path=args.lib if args.lib else os.path.join(root, ".rename_lib"),
+            collapse_self_dir=args.collapse_self_dir,
+            scan_workers=args.scan_workers,
+            dry_run=args.dry_run,
+            workers=args.workers,
+            lib_format=args.lib_format,
+            resume=args.resume,
+            processes=args.processes,
+        )
+
+    def _repack_root(root: str) -> RepackResult:
+        return cmd_repack(
+            root=root,
+            lib_path=args.lib if args.lib else os.path.join(root, ".rename_lib"),
+            keep_lib=args.keep_lib,
+            workers=args.workers,
+            resume=args.resume,
+        )
+
+    run_one = _rename_root if args.command == "rename" else _repack_root
+    if _run_roots(args.dir, run_one, args.root_workers):
+        sys.exit(1)
 
 
 if __name__ == "__main__":